@@ -0,0 +1 @@
+# Бенчмарки горячих путей bot.py; запуск из корня репозитория: python -m bench.<модуль>
@@ -0,0 +1,229 @@
+# Локальная подмена Telegram Bot API для нагрузочных тестов (bench/load.py): то подмножество
+# методов, которым пользуется bot.py. Бот направляется сюда через TELEGRAM_API_URL/TELEGRAM_FILE_URL.
+#
+#   getMe, getUpdates (long polling), setWebhook/deleteWebhook (после setWebhook обновления
+#   отправляются POST-запросом на адрес бота), sendMessage, editMessageText, sendDocument,
+#   getFile + скачивание /file/bot<token>/<path>, answerCallbackQuery; остальное — ok/true.
+#
+# Обновления подкладывает тест через push(); каждое исходящее сообщение бота уходит в
+# on_reply(chat_id, method, message) — по нему тест считает задержку до ответа.
+import itertools, json, os, threading, time, urllib.request
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+def _parse_multipart(ctype, body):
+    # sendDocument с загрузкой файла: поля формы -> str, файлы -> размер в байтах
+    msg = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + ctype.encode() + b"\r\n\r\n" + body)
+    params = {}
+    for part in msg.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        data = part.get_payload(decode=True) or b""
+        params[name] = {"file_name": part.get_filename(), "size": len(data)} if part.get_filename() else data.decode()
+    return params
+
+class FakeBotAPI:
+    def __init__(self, host="127.0.0.1", port=0, on_reply=None, pushers=32):
+        self.on_reply = on_reply
+        self.calls = Counter()
+        self.ready = threading.Event()  # бот пришёл за обновлениями или поставил webhook
+        self.webhook = None
+        self._cond = threading.Condition()
+        self._updates = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._files = {}  # file_id -> (file_path, путь на диске или None)
+        self._pushers = ThreadPoolExecutor(max_workers=pushers, thread_name_prefix="push")
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # urllib3 в PTB держит соединения открытыми
+
+            def do_GET(self):
+                self._route()
+
+            def do_POST(self):
+                self._route()
+
+            def _route(self):
+                u = urlparse(self.path)
+                parts = u.path.strip("/").split("/")
+                raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                if parts[0] == "file":
+                    return self._file("/".join(parts[2:]))
+                if len(parts) != 2 or not parts[0].startswith("bot"):
+                    return self._send(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+                ctype = self.headers.get("Content-Type", "")
+                if ctype.startswith("application/json"):
+                    params = json.loads(raw or b"{}")
+                elif ctype.startswith("multipart/form-data"):
+                    params = _parse_multipart(ctype, raw)
+                else:
+                    params = dict(parse_qsl(raw.decode() or u.query))
+                try:
+                    result = api.call(parts[1], params)
+                except KeyError as e:
+                    return self._send(400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"})
+                self._send(200, {"ok": True, "result": result})
+
+            def _file(self, file_path):
+                path = next((p for fp, p in api._files.values() if fp == file_path), None)
+                if not path or not os.path.isfile(path):
+                    return self._send(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+                api.calls["download"] += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(os.path.getsize(path)))
+                self.end_headers()
+                with open(path, "rb") as f:
+                    while True:
+                        chunk = f.read(1 << 16)
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+
+            def _send(self, code, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 1024
+
+        self._srv = Server((host, port), Handler)
+        self.url = f"http://{host}:{self._srv.server_address[1]}"
+
+    # адреса для TELEGRAM_API_URL / TELEGRAM_FILE_URL
+    @property
+    def base_url(self):
+        return self.url + "/bot"
+
+    @property
+    def file_url(self):
+        return self.url + "/file/bot"
+
+    def start(self):
+        threading.Thread(target=self._srv.serve_forever, name="fake-api", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._srv.shutdown()
+        self._srv.server_close()
+        self._pushers.shutdown(wait=False)
+
+    def add_file(self, path, file_name=None, mime_type="application/zip"):
+        # файл на диске, который «прислал» пользователь -> поле document для Message
+        file_id, file_path = self._new_file(os.path.splitext(path)[1])
+        self._files[file_id] = (file_path, path)
+        return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_name": file_name or os.path.basename(path),
+                "mime_type": mime_type, "file_size": os.path.getsize(path)}
+
+    def _new_file(self, ext=""):
+        n = next(self._file_ids)
+        return f"F{n}", f"documents/file_{n}{ext}"
+
+    def push(self, update):
+        # -> update_id; с webhook обновление сразу уходит боту, иначе ждёт getUpdates
+        update = dict(update, update_id=next(self._update_ids))
+        if self.webhook:
+            self._pushers.submit(self._post_webhook, update)
+        else:
+            with self._cond:
+                self._updates.append(update)
+                self._cond.notify_all()
+        return update["update_id"]
+
+    def _post_webhook(self, update):
+        url, secret = self.webhook
+        req = urllib.request.Request(url, data=json.dumps(update).encode(), method="POST",
+                                     headers={"Content-Type": "application/json"})
+        if secret:
+            req.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+        for attempt in range(5):
+            try:
+                urllib.request.urlopen(req, timeout=30).close()
+                return
+            except OSError:
+                time.sleep(0.2 * (attempt + 1))  # Telegram тоже повторяет доставку
+        self.calls["webhook_failed"] += 1
+
+    def message(self, chat_id, **fields):
+        return dict(fields, message_id=next(self._message_ids), date=int(time.time()),
+                    chat={"id": int(chat_id), "type": "private"}, **{"from": BOT_USER})
+
+    def _reply(self, method, chat_id, msg):
+        if self.on_reply:
+            self.on_reply(int(chat_id), method, msg)
+        return msg
+
+    def call(self, method, params):
+        self.calls[method] += 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            self.ready.set()
+            return self._get_updates(int(params.get("offset") or 0), int(params.get("limit") or 100),
+                                     float(params.get("timeout") or 0))
+        if method == "setWebhook":
+            self.webhook = (params["url"], params.get("secret_token")) if params.get("url") else None
+            if self.webhook:
+                self.ready.set()
+            return True
+        if method == "deleteWebhook":
+            self.webhook = None
+            return True
+        if method == "sendMessage":
+            return self._reply(method, params["chat_id"], self.message(
+                params["chat_id"], text=params["text"], **_markup(params)))
+        if method == "editMessageText":
+            msg = self.message(params["chat_id"], text=params["text"], **_markup(params))
+            msg["message_id"] = int(params["message_id"])
+            return self._reply(method, params["chat_id"], msg)
+        if method == "sendDocument":
+            doc = params["document"]
+            if isinstance(doc, dict):  # загружен файлом: байты не храним, только выдаём file_id
+                file_id, _ = self._new_file()
+                doc = {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_name": doc["file_name"],
+                       "file_size": doc["size"]}
+            else:
+                doc = {"file_id": doc, "file_unique_id": f"u{doc}"}
+            extra = {"caption": params["caption"]} if params.get("caption") else {}
+            return self._reply(method, params["chat_id"], self.message(params["chat_id"], document=doc, **extra))
+        if method == "getFile":
+            file_id = params["file_id"]
+            file_path, path = self._files[file_id]
+            return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_path": file_path,
+                    "file_size": os.path.getsize(path) if path else 0}
+        return True  # answerCallbackQuery, setMyCommands и прочее
+
+    def _get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                while self._updates and self._updates[0]["update_id"] < offset:
+                    self._updates.popleft()  # подтверждены offset'ом
+                if self._updates:
+                    return list(itertools.islice(self._updates, limit))
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return []
+                self._cond.wait(left)
+
+def _markup(params):
+    rm = params.get("reply_markup")
+    if isinstance(rm, str):
+        rm = json.loads(rm)
+    return {"reply_markup": rm} if rm else {}
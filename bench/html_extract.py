@@ -0,0 +1,41 @@
+# Разбор HTML-выгрузки: ссылки на профили одной регуляркой против старого HTMLParser по текстовым узлам.
+# python -m bench.html_extract [N]   (N — записей в followers_1.html, по умолчанию 100000)
+import re, sys
+from html.parser import HTMLParser
+import bot
+from bench.json_extract import best_of
+from bench.synth import fake_names, html_page
+
+class LegacyHTMLUserParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.users = set()
+    def handle_data(self, data):
+        s = data.strip()
+        if s and len(s) <= 50 and (" " not in s or s.count(" ") <= 1):
+            if re.match(r"^[A-Za-z0-9._]+$", s):
+                self.users.add(s.lower())
+
+def legacy_extract(html):
+    p = LegacyHTMLUserParser()
+    p.feed(html)
+    return p.users
+
+def new_extract(html, chunk=bot.ZIP_CHUNK):
+    return bot.extract_html_users((html[i:i + chunk] for i in range(0, len(html), chunk)), "followers_1.html")[1]
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    names = fake_names(n, 3)
+    html = html_page("Followers", names)
+    mb = len(html.encode("utf-8")) / 1e6
+    t_legacy, r_legacy = best_of(lambda: legacy_extract(html))
+    t_new, r_new = best_of(lambda: new_extract(html))
+    assert r_new == {u.lower() for u in names}
+    noise = len(r_legacy - r_new)
+    print(f"followers_1.html {n} записей, {mb:.1f} MB")
+    print(f"legacy  {t_legacy:6.3f}s  {mb / t_legacy:7.1f} MB/s  (лишних токенов: {noise})")
+    print(f"anchors {t_new:6.3f}s  {mb / t_new:7.1f} MB/s  (x{t_legacy / t_new:.1f})")
+
+if __name__ == "__main__":
+    main()
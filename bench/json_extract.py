@@ -0,0 +1,69 @@
+# Разбор JSON-членов архива: быстрый путь для известных раскладок против общего обходчика
+# и старого варианта (json.loads целиком + два рекурсивных обхода).
+# python -m bench.json_extract [N]   (N — записей в каждом списке, по умолчанию 100000)
+import io, json, sys, time
+import bot
+from bench.synth import fake_names, entry
+
+def legacy_extract(raw):
+    data = json.loads(raw.decode("utf-8"))
+    def collect_from(obj, key_candidates):
+        result = set()
+        def walk(x):
+            if isinstance(x, dict):
+                for k, v in x.items():
+                    if k.lower() in key_candidates and isinstance(v, list):
+                        for item in v:
+                            if isinstance(item, dict):
+                                u = item.get("username")
+                                if not u:
+                                    sld = item.get("string_list_data")
+                                    if isinstance(sld, list) and sld:
+                                        u = sld[0].get("value")
+                                if u:
+                                    result.add(u.strip().lower())
+                    walk(v)
+            elif isinstance(x, list):
+                for it in x:
+                    walk(it)
+        walk(obj)
+        return result
+    return collect_from(data, bot.FOLLOWERS_KEYS), collect_from(data, bot.FOLLOWING_KEYS)
+
+def generic_extract(raw):
+    fw, fg = set(), set()
+    bot.extract_generic(bot.JsonStream(io.BytesIO(raw)), fw, fg)
+    return fw, fg
+
+def known_extract(raw, kind):
+    fw, fg = set(), set()
+    bot.extract_known(bot.JsonStream(io.BytesIO(raw)), kind, fw, fg)
+    return fw, fg
+
+def best_of(fn, repeat=3):
+    best, out = None, None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = fn()
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    return best, out
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    docs = {
+        "followers_1.json": ("followers", {"relationships_followers": [entry(u) for u in fake_names(n, 1)]}),
+        "following.json": ("following", {"relationships_following": [entry(u) for u in fake_names(n, 2)]}),
+    }
+    print(f"{n} записей на файл")
+    for name, (kind, doc) in docs.items():
+        raw = json.dumps(doc, indent=2).encode("utf-8")
+        t_legacy, r_legacy = best_of(lambda: legacy_extract(raw))
+        t_generic, r_generic = best_of(lambda: generic_extract(raw))
+        t_known, r_known = best_of(lambda: known_extract(raw, kind))
+        assert r_legacy == r_generic == r_known
+        print(f"{name:18} {len(raw) / 1e6:6.1f} MB  legacy {t_legacy:6.3f}s  generic {t_generic:6.3f}s  "
+              f"known {t_known:6.3f}s  (x{t_legacy / t_known:.1f})")
+
+if __name__ == "__main__":
+    main()
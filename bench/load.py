@@ -0,0 +1,232 @@
+# Нагрузочный тест бота целиком: bot.py в отдельном процессе против фейкового Bot API
+# (bench/fake_api.py) и тысячи виртуальных пользователей. Каждый пользователь:
+#   присылает ZIP-выгрузку -> открывает список -> листает «Ещё» -> вставляет following и
+#   followers текстом -> иногда просит ZIP-отчёт.
+# Следующее действие — только после ответа бота на предыдущее, как у живого человека.
+#
+#   python -m bench.load                                  # 1000 пользователей, 200 одновременно
+#   python -m bench.load --users 5000 --concurrency 1000 --size 5000
+#   python -m bench.load --webhook 4                      # webhook-режим с 4 воркерами
+#   OUT_CHAT_RATE=100 BOT_WORKERS=16 python -m bench.load # настройки бота — через окружение
+#
+# Задержка — от отдачи обновления боту до первого сообщения бота в этот чат (sendMessage,
+# editMessageText или sendDocument). Ответ «занято» (BUSY_TEXT) в задержку не идёт: действие
+# повторяется через секунду и считается в колонке «занято». Печатает перцентили по типам
+# действий и обновления/с, с --out пишет то же в JSON. База и отчёты бота — во временном каталоге.
+import argparse, json, os, random, shutil, signal, socket, subprocess, sys, tempfile, threading, time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from bench import synth
+from bench.fake_api import FakeBotAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUSY_PREFIX = "⏳"  # BUSY_TEXT: бот отклонил тяжёлую задачу, пользователь пришлёт её ещё раз
+TOKEN = "123456:LOADTEST"
+FIRST_UID = 10_000_000
+
+class Waiter:
+    __slots__ = ("event", "t", "msg")
+    def __init__(self):
+        self.event = threading.Event()
+        self.t = self.msg = None
+
+class Load:
+    def __init__(self, args, archives):
+        self.args = args
+        self.archives = archives  # [document] — общий набор выгрузок разного состава
+        self.waiters = {}
+        self.lock = threading.Lock()
+        self.lat = defaultdict(list)
+        self.timeouts = defaultdict(int)
+        self.busy = defaultdict(int)
+        self.updates = 0
+        self.api = FakeBotAPI(on_reply=self.on_reply).start()
+
+    def on_reply(self, chat, method, msg):
+        with self.lock:
+            w = self.waiters.pop(chat, None)
+        if w:
+            w.t, w.msg = time.perf_counter(), msg
+            w.event.set()
+
+    def act(self, uid, kind, **body):
+        # -> ответ бота (dict Message) или None по таймауту; на «занято» повторяем через секунду
+        for _ in range(self.args.retries):
+            msg, dt = self._act_once(uid, kind, body)
+            if msg is None:
+                return None
+            with self.lock:
+                if not (msg.get("text") or "").startswith(BUSY_PREFIX):
+                    self.lat[kind].append(dt)
+                    return msg
+                self.busy[kind] += 1
+            time.sleep(1)
+        return None
+
+    def _act_once(self, uid, kind, body):
+        w = Waiter()
+        with self.lock:
+            self.waiters[uid] = w
+            self.updates += 1
+        t0 = time.perf_counter()
+        self.api.push(body)
+        if not w.event.wait(self.args.timeout):
+            with self.lock:
+                self.waiters.pop(uid, None)
+                self.timeouts[kind] += 1
+            return None, None
+        return w.msg, w.t - t0
+
+    def send(self, uid, kind, **fields):
+        user = {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+        msg = dict(fields, message_id=random.randrange(1, 1 << 30), date=int(time.time()),
+                   chat={"id": uid, "type": "private"}, **{"from": user})
+        return self.act(uid, kind, message=msg)
+
+    def click(self, uid, kind, msg, data):
+        user = {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+        cq = {"id": str(random.getrandbits(48)), "from": user, "chat_instance": str(uid), "data": data, "message": msg}
+        return self.act(uid, kind, callback_query=cq)
+
+    def session(self, i):
+        uid = FIRST_UID + i
+        rnd = random.Random(i)
+        menu = self.send(uid, "zip", document=rnd.choice(self.archives))
+        if menu is None:
+            return
+        page = self.page_through(uid, menu, rnd)
+        following, followers = synth.make_lists(self.args.paste, seed=i)
+        if self.send(uid, "text", text=synth.make_paste(following)) is None:
+            return
+        menu = self.send(uid, "text", text=synth.make_paste(followers))
+        if menu is None:
+            return
+        if rnd.random() < self.args.report_share:
+            self.click(uid, "report", page or menu, "download_zip")
+
+    def page_through(self, uid, menu, rnd):
+        buttons = [b["callback_data"] for row in (menu.get("reply_markup") or {}).get("inline_keyboard", [])
+                   for b in row if b.get("callback_data", "").startswith("page|") and not b["text"].endswith("(0)")]
+        if not buttons:
+            return None
+        page = self.click(uid, "page", menu, rnd.choice(buttons))
+        for _ in range(self.args.pages):
+            more = [b["callback_data"] for row in (page or {}).get("reply_markup", {}).get("inline_keyboard", [])
+                    for b in row if b["text"].startswith("Ещё")]
+            if not more:
+                break
+            page = self.click(uid, "more", page, more[0]) or page
+        return page
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_bot(api, workdir, webhook):
+    env = dict(os.environ, TELEGRAM_TOKEN=TOKEN, TELEGRAM_API_URL=api.base_url, TELEGRAM_FILE_URL=api.file_url,
+               REPORT_DIR=os.path.join(workdir, "reports"), PYTHONUNBUFFERED="1")
+    env.pop("ALLOWED_CHAT_IDS", None)
+    if webhook:
+        port = free_port()
+        env.update(WEBHOOK_URL=f"http://127.0.0.1:{port}/hook", WEBHOOK_LISTEN="127.0.0.1",
+                   WEBHOOK_PORT=str(port), WEBHOOK_WORKERS=str(webhook))
+    log = open(os.path.join(workdir, "bot.log"), "w")
+    # cwd — временный каталог: там же окажется bot_data.db
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "bot.py")], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+def stop_bot(proc):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(20)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+def pct(xs, q):
+    return xs[min(len(xs) - 1, int(q * len(xs)))] if xs else float("nan")
+
+def summarize(load, wall):
+    rows = {}
+    for kind in ("zip", "page", "more", "text", "report"):
+        xs = sorted(load.lat[kind])
+        if not xs and not load.timeouts[kind]:
+            continue
+        rows[kind] = {"n": len(xs), "timeouts": load.timeouts[kind], "busy": load.busy[kind], "p50": pct(xs, 0.5), "p90": pct(xs, 0.9),
+                      "p99": pct(xs, 0.99), "max": xs[-1] if xs else float("nan")}
+    everything = sorted(x for xs in load.lat.values() for x in xs)
+    rows["all"] = {"n": len(everything), "timeouts": sum(load.timeouts.values()), "busy": sum(load.busy.values()), "p50": pct(everything, 0.5),
+                   "p90": pct(everything, 0.9), "p99": pct(everything, 0.99),
+                   "max": everything[-1] if everything else float("nan")}
+    return {"wall_sec": wall, "updates": load.updates, "updates_per_sec": load.updates / wall if wall else 0,
+            "latency": rows, "api_calls": dict(load.api.calls)}
+
+def main():
+    ap = argparse.ArgumentParser(description="Нагрузочный тест бота против фейкового Bot API")
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--concurrency", type=int, default=200, help="пользователей одновременно")
+    ap.add_argument("--size", type=int, default=2000, help="подписчиков в ZIP-выгрузке")
+    ap.add_argument("--archives", type=int, default=8, help="разных выгрузок на всех пользователей")
+    ap.add_argument("--paste", type=int, default=60, help="имён во вставленном тексте")
+    ap.add_argument("--pages", type=int, default=2, help="нажатий «Ещё» после открытия списка")
+    ap.add_argument("--report-share", type=float, default=0.1, help="доля пользователей, скачивающих отчёт")
+    ap.add_argument("--timeout", type=float, default=120, help="сколько ждать ответа на одно действие, с")
+    ap.add_argument("--retries", type=int, default=10, help="попыток на действие, если бот ответил «занято»")
+    ap.add_argument("--webhook", type=int, default=0, metavar="N", help="webhook-режим с N воркерами")
+    ap.add_argument("--out", help="записать результат в JSON")
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="igload_")
+    proc = load = None
+    try:
+        archives = []
+        base_following, base_followers = synth.make_lists(args.size)
+        for k in range(max(1, args.archives)):
+            path = os.path.join(workdir, f"instagram-export-{k}.zip")
+            synth.write_json_zip(path, synth.churn(base_following, 0.05, seed=2 * k),
+                                 synth.churn(base_followers, 0.05, seed=2 * k + 1))
+            archives.append(path)
+        load = Load(args, [])
+        load.archives = [load.api.add_file(p) for p in archives]
+
+        proc = start_bot(load.api, workdir, args.webhook)
+        if not load.api.ready.wait(60) or proc.poll() is not None:
+            with open(os.path.join(workdir, "bot.log")) as f:
+                print("бот не поднялся:\n" + f.read()[-4000:])
+            sys.exit(1)
+        mode = f"webhook x{args.webhook}" if args.webhook else "polling"
+        print(f"{args.users} пользователей, {args.concurrency} одновременно, выгрузки по {args.size}, {mode}", flush=True)
+
+        t0 = time.perf_counter()
+        done = [0]
+        def run(i):
+            load.session(i)
+            done[0] += 1
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = [pool.submit(run, i) for i in range(args.users)]
+            while not all(f.done() for f in futures):
+                time.sleep(2)
+                dt = time.perf_counter() - t0
+                print(f"  [{done[0]}/{args.users}] {load.updates / dt:.1f} обн/с", flush=True)
+            for f in futures:
+                f.result()
+        result = summarize(load, time.perf_counter() - t0)
+    finally:
+        if proc is not None:
+            stop_bot(proc)
+        if load is not None:
+            load.api.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{result['updates']} обновлений за {result['wall_sec']:.1f} с — {result['updates_per_sec']:.1f} обн/с")
+    print(f"{'действие':8} {'n':>7} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8} {'таймауты':>9} {'занято':>7}")
+    for kind, r in result["latency"].items():
+        print(f"{kind:8} {r['n']:7} {r['p50']:8.3f} {r['p90']:8.3f} {r['p99']:8.3f} {r['max']:8.3f} {r['timeouts']:9} {r['busy']:7}")
+    print("вызовы API:", ", ".join(f"{k} {v}" for k, v in sorted(result["api_calls"].items())))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == "__main__":
+    main()
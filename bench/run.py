@@ -0,0 +1,168 @@
+# Набор бенчмарков горячих путей bot.py на синтетических выгрузках, без сети и Telegram.
+#
+#   python -m bench.run                               # 1k,10k,100k -> bench_results.json
+#   python -m bench.run --sizes 1k,1m --repeat 5
+#   python -m bench.run --out new.json --compare bench_results.json --threshold 0.25
+#
+# Для каждой стадии и размера: лучшее и медианное время (без tracemalloc) и пик памяти Python
+# (отдельный прогон под tracemalloc). С --compare печатает сравнение и выходит с кодом 1,
+# если какая-то стадия стала медленнее больше чем на threshold.
+import argparse, gc, json, os, platform, shutil, statistics, subprocess, sys, tempfile, time, tracemalloc
+from array import array
+import bot
+from bench import synth
+
+class StubMessage:
+    # вместо telegram.Message: копим ответы, ничего не отправляем
+    document = None
+    text = None
+    chat_id = 0
+    def __init__(self):
+        self.sent = []
+    def reply_text(self, text, **kwargs):
+        self.sent.append(text)
+    def reply_document(self, document=None, **kwargs):
+        self.sent.append(document)
+
+class StubUser:
+    def __init__(self, uid):
+        self.id = uid
+
+class StubUpdate:
+    def __init__(self, uid):
+        self.message = self.effective_message = StubMessage()
+        self.effective_user = StubUser(uid)
+        self.callback_query = None
+
+def parse_size(s):
+    s = s.strip().lower()
+    mult = {"k": 1_000, "m": 1_000_000}.get(s[-1], 1)
+    return int(float(s.rstrip("km")) * mult)
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"sec": min(times), "median_sec": statistics.median(times), "peak_mb": round(peak / 1e6, 2)}
+
+def bench_size(n, repeat, workdir):
+    following, followers = synth.make_lists(n, seed=n)
+    following2 = synth.churn(following, 0.02, seed=n + 1)
+    followers2 = synth.churn(followers, 0.02, seed=n + 2)
+    json_zip = os.path.join(workdir, f"json_{n}.zip")
+    html_zip = os.path.join(workdir, f"html_{n}.zip")
+    synth.write_json_zip(json_zip, following, followers)
+    synth.write_html_zip(html_zip, following, followers)
+    paste = synth.make_paste(followers)
+
+    uid = 10_000_000 + n
+    A, B = set(following), set(followers)
+    A2, B2 = set(following2), set(followers2)
+    bot.process_sets_and_reply(StubUpdate(uid), None, uid, A, B)  # первый снимок — база для diff
+    ids = bot.intern_usernames(A | B | A2 | B2)
+    states = [
+        (array("I", sorted(ids[u] for u in A)), array("I", sorted(ids[u] for u in B))),
+        (array("I", sorted(ids[u] for u in A2)), array("I", sorted(ids[u] for u in B2))),
+    ]
+    res = bot.get_lists(uid)
+
+    uploads = [(A, B), (A2, B2)]
+
+    def process_next():
+        # тоже чередуем: одинаковая повторная загрузка ушла бы по короткому пути (process_unchanged)
+        uploads.reverse()
+        bot.process_sets_and_reply(StubUpdate(uid), None, uid, *uploads[0])
+
+    def save_next():
+        # чередуем два состояния, чтобы каждый раз писалась настоящая дельта в ~2%
+        states.reverse()
+        bot.save_snapshot(uid + 1, *states[0])
+
+    stages = {
+        "parse_zip_json": lambda: bot.parse_zip_for_users(json_zip),
+        "parse_zip_html": lambda: bot.parse_zip_for_users(html_zip),
+        "to_user_set": lambda: bot.to_user_set(paste),
+        "process_sets_and_reply": process_next,
+        "process_unchanged": lambda: bot.process_sets_and_reply(StubUpdate(uid), None, uid, *uploads[0]),
+        "save_snapshot": save_next,
+        "load_last_snapshot": lambda: bot.load_last_snapshot(uid),
+        "build_zip_report": lambda: bot.write_report_zip(os.path.join(workdir, f"report_{n}.zip"), bot.DB_PATH, res.report_lists()),
+    }
+    out = {}
+    for name, fn in stages.items():
+        r = measure(fn, repeat)
+        r["usernames"] = n
+        out[f"{name}@{n}"] = r
+        print(f"{name:24} {n:>9}  {r['sec']:8.4f}s  (median {r['median_sec']:.4f}s)  peak {r['peak_mb']:8.2f} MB", flush=True)
+    return out
+
+def git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+def compare(new, old, threshold):
+    worse = []
+    print(f"\n{'stage':34} {'old s':>9} {'new s':>9} {'ratio':>7}")
+    for key, r in new["results"].items():
+        o = old["results"].get(key)
+        if not o:
+            continue
+        ratio = r["sec"] / o["sec"] if o["sec"] else float("inf")
+        flag = "  <-- регрессия" if ratio > 1 + threshold else ""
+        print(f"{key:34} {o['sec']:9.4f} {r['sec']:9.4f} {ratio:7.2f}{flag}")
+        if flag:
+            worse.append(key)
+    return worse
+
+def main():
+    ap = argparse.ArgumentParser(description="Бенчмарки bot.py на синтетических выгрузках Instagram")
+    ap.add_argument("--sizes", default="1k,10k,100k", help="сколько подписчиков: 1k,10k,100k,1m")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--out", default="bench_results.json")
+    ap.add_argument("--compare", help="прошлый файл результатов для сравнения")
+    ap.add_argument("--threshold", type=float, default=0.25, help="допустимое замедление, доля")
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="igbench_")
+    bot.DB_PATH = os.path.join(workdir, "bench.db")
+    bot.init_db()
+    results = {}
+    try:
+        for size in args.sizes.split(","):
+            results.update(bench_size(parse_size(size), args.repeat, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    doc = {
+        "meta": {
+            "git": git_rev(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(doc, f, indent=2, ensure_ascii=False)
+    print(f"\nрезультаты: {args.out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            old = json.load(f)
+        if compare(doc, old, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
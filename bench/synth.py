@@ -0,0 +1,64 @@
+# Синтетические выгрузки Instagram для бенчмарков — те же раскладки, что в «Download your information»:
+#   connections/followers_and_following/followers_1.json, followers_2.json, ... (список записей)
+#   connections/followers_and_following/following.json ({"relationships_following": [...]})
+# и HTML-вариант с ссылками на профили. Всё детерминировано по seed.
+import json, random, string, zipfile
+
+FOLLOW_DIR = "connections/followers_and_following/"
+PART_SIZE = 50_000  # Instagram режет большой список подписчиков на несколько файлов
+
+def fake_names(n, seed):
+    rnd = random.Random(seed)
+    alphabet = string.ascii_lowercase + string.digits + "._"
+    return [rnd.choice(string.ascii_lowercase) + "".join(rnd.choices(alphabet, k=rnd.randint(4, 14))) + str(i)
+            for i in range(n)]
+
+def entry(u, ts=1700000000):
+    return {
+        "title": "",
+        "media_list_data": [],
+        "string_list_data": [{"href": f"https://www.instagram.com/{u}", "value": u, "timestamp": ts}],
+    }
+
+def make_lists(n, seed=0, mutual_share=0.4):
+    # (following, followers): n подписчиков, ~0.8n подписок, mutual_share из них взаимные
+    followers = fake_names(n, seed)
+    n_following = int(n * 0.8)
+    n_mutual = int(n_following * mutual_share)
+    following = followers[:n_mutual] + fake_names(n_following - n_mutual, seed + 1000)
+    return following, followers
+
+def churn(names, share, seed):
+    # следующий снимок: часть имён ушла, столько же новых пришло
+    rnd = random.Random(seed)
+    k = int(len(names) * share)
+    kept = rnd.sample(names, len(names) - k)
+    return kept + fake_names(k, seed + 2000)
+
+def write_json_zip(path, following, followers, part_size=PART_SIZE, media_bytes=0):
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        for i in range(0, max(len(followers), 1), part_size):
+            part = [entry(u) for u in followers[i:i + part_size]]
+            z.writestr(f"{FOLLOW_DIR}followers_{i // part_size + 1}.json", json.dumps(part, indent=2))
+        doc = {"relationships_following": [entry(u) for u in following]}
+        z.writestr(f"{FOLLOW_DIR}following.json", json.dumps(doc, indent=2))
+        if media_bytes:
+            z.writestr("media/posts/202401/photo.jpg", random.Random(0).randbytes(media_bytes), zipfile.ZIP_STORED)
+
+def html_page(title, names):
+    rows = "".join(
+        '<div class="pam _3-95 _2ph- _a6-g uiBoxWhite noborder"><div class="_a6-p"><div><div>'
+        f'<a target="_blank" href="https://www.instagram.com/{u}">{u}</a></div>'
+        '<div>Jan 01, 2024 10:00 am</div></div></div></div>'
+        for u in names
+    )
+    return f"<html><head><title>{title}</title></head><body><main>{rows}</main></body></html>"
+
+def write_html_zip(path, following, followers):
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr(f"{FOLLOW_DIR}followers_1.html", html_page("Followers", followers))
+        z.writestr(f"{FOLLOW_DIR}following.html", html_page("Following", following))
+
+def make_paste(names):
+    # как копирование списка из браузера: ник, имя, кнопка
+    return "\n".join(f"{u}\n{u.split('.')[0].title()} Test\nFollow" for u in names)
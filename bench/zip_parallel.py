@@ -0,0 +1,42 @@
+# Многочастная выгрузка (followers_1.json ... followers_K.json + following.json): разбор всего
+# архива одной задачей против parse_zip_parallel, раздающего члены пулу процессов.
+# python -m bench.zip_parallel [N] [--workers 1,2,4]   (N — подписчиков, по умолчанию 1000000)
+import argparse, os, shutil, tempfile, zipfile
+import bot
+from bench import synth
+from bench.json_extract import best_of
+
+def main():
+    ap = argparse.ArgumentParser(description="Параллельный разбор членов одного архива")
+    ap.add_argument("n", nargs="?", type=int, default=1_000_000)
+    ap.add_argument("--workers", default="1,2,4")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="igbench_")
+    try:
+        path = os.path.join(workdir, "export.zip")
+        following, followers = synth.make_lists(args.n)
+        synth.write_json_zip(path, following, followers)
+        with zipfile.ZipFile(path) as z:
+            parts = len(bot._zip_members(z))
+        print(f"{args.n} подписчиков, {parts} членов, {os.path.getsize(path) / 1e6:.1f} MB, ядер: {os.cpu_count()}")
+
+        base, expected = best_of(lambda: bot.parse_zip_for_users(path), args.repeat)
+        print(f"{'один процесс':16} {base:7.3f}s")
+        for w in (int(x) for x in args.workers.split(",")):
+            bot.CPU_WORKERS = w
+            bot.start_cpu_pool()
+            try:
+                bot.run_cpu_many(len, [((),)] * w)  # поднять процессы до замера
+                t, got = best_of(lambda: bot.parse_zip_parallel(path), args.repeat)
+            finally:
+                bot._cpu_pool.shutdown()
+                bot._cpu_pool = None
+            assert got == expected
+            print(f"{f'пул x{w}':16} {t:7.3f}s  (x{base / t:.2f})")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
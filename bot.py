@@ -1,22 +1,36 @@
 # bot.py — v3.4: удобства + wipe + howto + ZIP-отчёт + retention + whitelist
-import os, io, csv, json, sqlite3, datetime, zipfile, re, textwrap
-from html.parser import HTMLParser
+import os, io, sys, csv, json, sqlite3, datetime, time, zipfile, re, string, textwrap, codecs, shutil, tempfile, hashlib, secrets
+import urllib.request, threading, functools, multiprocessing, queue, bisect, contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from array import array
 from dotenv import load_dotenv
-from telegram import InputFile, InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, Filters, CallbackContext
+from telegram import Bot, InputFile, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, RetryAfter
+from telegram.utils.request import Request
+from telegram.ext import Updater, Dispatcher, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, Filters, CallbackContext
 
 # ---------- ENV / Config ----------
 load_dotenv()
-TOKEN = os.getenv("TELEGRAM_TOKEN")
-if not TOKEN:
-    print("Error: TELEGRAM_TOKEN not set in .env")
-    exit(1)
+TOKEN = os.getenv("TELEGRAM_TOKEN")  # проверяется в main(): без токена модуль можно импортировать (бенчмарки)
 
 DB_PATH = "bot_data.db"
+# каждый N-й снимок пользователя хранится целиком, между ними — только дельты (+/-)
+KEYFRAME_EVERY = int(os.getenv("KEYFRAME_EVERY", "16"))
 PAGE_SIZE = 50  # сколько имён показывать за раз
 
 # retention (опционально): удалить снимки старше N дней (например 60)
 RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))  # 0 = выкл.
+RETENTION_SWEEP_SEC = int(os.getenv("RETENTION_SWEEP_SEC", "600"))  # как часто фоновый чистильщик проходит по базе
+RETENTION_BATCH = 200  # снимков за одну транзакцию удаления
+# никнеймы, на которые больше не ссылается ни снимок, ни сессия (после /wipe и retention),
+# удаляются из словаря за два прохода чистильщика; 0 = не чистить
+NAMES_SWEEP_SEC = int(os.getenv("NAMES_SWEEP_SEC", "3600"))
 
 # приватный доступ (опционально): перечисли chat_id через запятую
 _allowed = os.getenv("ALLOWED_CHAT_IDS", "").strip()
@@ -24,13 +38,509 @@ ALLOWED_CHAT_IDS = set(x.strip() for x in _allowed.split(",") if x.strip())
 
 SESSION_TTL_MIN = 60  # сколько минут живёт незавершённая загрузка (following->followers)
 
+# кеши в памяти: списки для кнопок и незавершённые загрузки; вытесненное восстанавливается из SQLite
+CACHE_MAX_MB = int(os.getenv("CACHE_MAX_MB", "256"))
+CACHE_TTL_MIN = int(os.getenv("CACHE_TTL_MIN", "120"))
+CACHE_SWEEP_SEC = 30
+
+# рантайм: потоки диспетчера (все обработчики run_async), процессы для CPU-работы и лимиты тяжёлых задач
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "32"))  # ждущая своей очереди тяжёлая задача тоже держит поток
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(min(4, os.cpu_count() or 1))))
+MAX_HEAVY_JOBS = int(os.getenv("MAX_HEAVY_JOBS", str(CPU_WORKERS + 2)))  # выполняются одновременно
+# сколько тяжёлых задач может ждать слота и сколько ждать; 4 потока всегда остаются под кнопки
+HEAVY_QUEUE_LIMIT = max(0, BOT_WORKERS - MAX_HEAVY_JOBS - 4)
+HEAVY_WAIT_SEC = int(os.getenv("HEAVY_WAIT_SEC", "120"))
+USER_QUEUE_LIMIT = 3  # сколько тяжёлых задач одного пользователя может быть в работе и очереди
+CPU_OFFLOAD_MIN_CHARS = 64 * 1024  # текст короче разбираем прямо в потоке — IPC дороже
+
+# исходящие: глобальный лимит Bot API и лимит на чат (сообщений в секунду, с коротким всплеском)
+OUT_GLOBAL_RATE = float(os.getenv("OUT_GLOBAL_RATE", "25"))
+OUT_CHAT_RATE = float(os.getenv("OUT_CHAT_RATE", "1"))
+OUT_CHAT_BURST = 3
+OUT_SENDERS = int(os.getenv("OUT_SENDERS", "4"))  # потоков, параллельно ждущих ответа API
+
+# webhook (опционально): если задан WEBHOOK_URL, Telegram шлёт обновления туда, а локальный
+# сервер на WEBHOOK_LISTEN:WEBHOOK_PORT раскладывает их по WEBHOOK_WORKERS процессам по user_id
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 1)))
+
+# адрес Bot API: свой локальный сервер или фейковый из bench/fake_api.py для нагрузочных тестов
+API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+API_FILE_URL = os.getenv("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+
+# готовые ZIP-отчёты (по одному на пользователя, для последнего снимка)
+REPORT_DIR = os.getenv("REPORT_DIR", "reports")
+
+# метрики (опционально): METRICS=1 включает сбор, METRICS_PORT — HTTP /metrics в формате Prometheus
+METRICS_ENABLED = os.getenv("METRICS", "") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# кому доступна команда /metrics: chat_id через запятую
+ADMIN_IDS = set(x.strip() for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip())
+
+# ---------- Metrics ----------
+# Гистограммы и счётчики в памяти процесса. При выключенных метриках observe/inc сразу
+# возвращаются, timed() отдаёт общий пустой контекст, а metered() не оборачивает обработчик.
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_metrics_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [по корзинам..., +Inf, sum]
+_received_at = OrderedDict()  # update_id -> monotonic() при получении диспетчером
+_NOOP_TIMER = contextlib.nullcontext()
+
+def inc(name, value=1, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(METRIC_BUCKETS) + 2)
+        h[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        h[-1] += seconds
+
+class _Timer:
+    __slots__ = ("name", "labels", "t0")
+    def __init__(self, name, labels):
+        self.name, self.labels = name, labels
+    def __enter__(self):
+        self.t0 = time.monotonic()
+        return self
+    def __exit__(self, *exc):
+        observe(self.name, time.monotonic() - self.t0, **self.labels)
+
+def timed(name, **labels):
+    return _Timer(name, labels) if METRICS_ENABLED else _NOOP_TIMER
+
+def _fmt_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def render_metrics():
+    with _metrics_lock:
+        counters = sorted(_counters.items())
+        hists = sorted((k, list(h)) for k, h in _histograms.items())
+    lines, typed = [], set()
+    def type_line(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+    for (name, labels), v in counters:
+        type_line(name, "counter")
+        lines.append(f"{name}{_fmt_labels(labels)} {v}")
+    for (name, labels), h in hists:
+        type_line(name, "histogram")
+        total = 0
+        for le, n in zip(METRIC_BUCKETS + ("+Inf",), h[:-1]):
+            total += n
+            lines.append(f"{name}_bucket{_fmt_labels(labels + (('le', le),))} {total}")
+        lines.append(f"{name}_sum{_fmt_labels(labels)} {h[-1]:.6f}")
+        lines.append(f"{name}_count{_fmt_labels(labels)} {total}")
+    for name, value, labels in _gauges():
+        type_line(name, "gauge")
+        lines.append(f"{name}{_fmt_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def _gauges():
+    yield "igbot_heavy_jobs", _jobs_running, ()
+    yield "igbot_heavy_jobs_waiting", _jobs_waiting, ()
+    yield "igbot_db_write_queue", _write_q.qsize(), ()
+    yield "igbot_cache_bytes", store_lists.bytes, (("cache", "lists"),)
+    yield "igbot_cache_bytes", user_stage.bytes, (("cache", "sessions"),)
+    yield "igbot_cache_bytes", parsed_uploads.bytes, (("cache", "uploads"),)
+    yield "igbot_cache_bytes", decoded_snapshots.bytes, (("cache", "snapshots"),)
+
+def stamp_update(update: Update, context: CallbackContext):
+    # из receive_update: отсюда считается время в очереди run_async
+    _received_at[update.update_id] = time.monotonic()
+    while len(_received_at) > 10000:
+        _received_at.popitem(last=False)
+
+CALLBACK_ACTIONS = {"menu", "howto", "ask_wipe", "wipe_confirm", "download_zip", "page"}
+
+def metered(handler):
+    if not METRICS_ENABLED:
+        return handler
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext):
+        t0 = time.monotonic()
+        received = _received_at.pop(update.update_id, None)
+        if received is not None:
+            observe("igbot_queue_seconds", t0 - received)
+        name = handler.__name__
+        if update.callback_query:
+            action = (update.callback_query.data or "").split("|", 1)[0]
+            name = "callback:" + (action if action in CALLBACK_ACTIONS else "other")
+        try:
+            return handler(update, context)
+        finally:
+            observe("igbot_handler_seconds", time.monotonic() - t0, handler=name)
+    return wrapper
+
+def start_metrics_server():
+    if not (METRICS_ENABLED and METRICS_PORT):
+        return
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render_metrics().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    srv = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    threading.Thread(target=srv.serve_forever, name="metrics", daemon=True).start()
+
+# ---------- Sorted id arrays ----------
+# Никнеймы интернируются в таблицу usernames (name -> int id), а снимки и diff'ы
+# работают с отсортированными array('I') id — линейные проходы слиянием вместо хеширования строк.
+def pack_ids(ids):
+    a = array("I", ids)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a.tobytes()
+
+def unpack_ids(blob):
+    a = array("I")
+    a.frombytes(blob)
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a
+
+def merge_diff(a, b):
+    # один проход по двум отсортированным массивам: (a & b, a - b, b - a)
+    both, only_a, only_b = array("I"), array("I"), array("I")
+    i = j = 0
+    na, nb = len(a), len(b)
+    while i < na and j < nb:
+        x, y = a[i], b[j]
+        if x == y:
+            both.append(x); i += 1; j += 1
+        elif x < y:
+            only_a.append(x); i += 1
+        else:
+            only_b.append(y); j += 1
+    only_a.extend(a[i:])
+    only_b.extend(b[j:])
+    return both, only_a, only_b
+
+def merge_union(a, b):
+    out = array("I")
+    i = j = 0
+    na, nb = len(a), len(b)
+    while i < na and j < nb:
+        x, y = a[i], b[j]
+        if x == y:
+            out.append(x); i += 1; j += 1
+        elif x < y:
+            out.append(x); i += 1
+        else:
+            out.append(y); j += 1
+    out.extend(a[i:])
+    out.extend(b[j:])
+    return out
+
 # ---------- DB ----------
-def conn_cur():
-    c = sqlite3.connect(DB_PATH)
-    return c, c.cursor()
+# Снимки хранятся цепочками: ключевой кадр (полные массивы id, base_id IS NULL)
+# и дальше дельты к предыдущему снимку того же пользователя (uint32 len(+) | +ids | -ids).
+# Инвариант: base_id дельты всегда указывает на предыдущий по id снимок этого user_id.
+#
+# Соединения: у каждого потока своё долгоживущее (WAL, кеш подготовленных выражений),
+# читают через read_tx(). Все записи идут через db_write(): один поток-писатель забирает
+# накопившиеся задачи и выполняет их одной транзакцией (каждую — в своём SAVEPOINT).
+DB_WRITE_BATCH = 64  # сколько задач записи максимум склеивать в одну транзакцию
+
+def _connect():
+    c = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=256)
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute("PRAGMA cache_size=-16000")
+    return c
+
+_local = threading.local()
+
+def db():
+    c = getattr(_local, "conn", None)
+    if c is None:
+        c = _local.conn = _connect()
+    return c
+
+@contextmanager
+def read_tx(op="read"):
+    # согласованное чтение нескольких запросов (снимок WAL на время блока); op — метка для метрик
+    c = db()
+    with timed("igbot_db_seconds", op=op):
+        c.execute("BEGIN")
+        try:
+            yield c.cursor()
+        finally:
+            c.execute("COMMIT")
+
+# одиночные запросы вне read_tx — тоже с меткой op в igbot_db_seconds
+def read_one(op, sql, args=()):
+    with timed("igbot_db_seconds", op=op):
+        return db().execute(sql, args).fetchone()
+
+def read_all(op, sql, args=()):
+    with timed("igbot_db_seconds", op=op):
+        return db().execute(sql, args).fetchall()
+
+_write_q = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+def _writer_loop():
+    c = _connect()
+    while True:
+        jobs = [_write_q.get()]
+        while len(jobs) < DB_WRITE_BATCH:
+            try:
+                jobs.append(_write_q.get_nowait())
+            except queue.Empty:
+                break
+        done = []
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for fn, args, fut in jobs:
+                c.execute("SAVEPOINT job")
+                try:
+                    with timed("igbot_db_seconds", op=fn.__name__.strip("_")):
+                        done.append((fut, fn(c.cursor(), *args), None))
+                    c.execute("RELEASE job")
+                except Exception as e:
+                    c.execute("ROLLBACK TO job")
+                    c.execute("RELEASE job")
+                    done.append((fut, None, e))
+            with timed("igbot_db_seconds", op="commit"):
+                c.execute("COMMIT")
+            inc("igbot_db_commits_total")
+            inc("igbot_db_write_jobs_total", len(jobs))
+        except Exception as e:
+            if c.in_transaction:
+                c.execute("ROLLBACK")
+            done = [(fut, None, e) for _, _, fut in jobs]
+        for fut, res, err in done:
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+def db_write(fn, *args):
+    # fn(cursor, *args) в потоке-писателе; возвращает результат fn после COMMIT
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+                _writer.start()
+    fut = Future()
+    _write_q.put((fn, args, fut))
+    return fut.result()
+
+def _migrate_delta_storage(c):
+    # v1: base_id + перекодирование старых полных JSON-снимков в ключевые кадры и JSON-дельты
+    c.execute("ALTER TABLE snapshots ADD COLUMN base_id INTEGER")
+    # строки читаем отдельным курсором по одной — история тяжёлого пользователя в память целиком
+    # не попадает; UPDATE уже прочитанной строки по id чтению не мешает
+    users = [r[0] for r in c.execute("SELECT DISTINCT user_id FROM snapshots").fetchall()]
+    for uid in users:
+        rows = c.connection.execute(
+            "SELECT id, following_json, followers_json FROM snapshots WHERE user_id=? ORDER BY id", (uid,)
+        )
+        prev, prev_id, since_key = None, None, 0
+        for sid, fwing, fwers in rows:
+            cur = (set(json.loads(fwing)), set(json.loads(fwers)))
+            enc = None
+            if prev is not None and since_key < KEYFRAME_EVERY - 1:
+                deltas = [(sorted(new - old), sorted(old - new)) for old, new in zip(prev, cur)]
+                if sum(len(a) + len(r) for a, r in deltas) * 2 <= len(cur[0]) + len(cur[1]):
+                    enc = [json.dumps({"+": a, "-": r}) for a, r in deltas]
+            if enc:
+                c.execute(
+                    "UPDATE snapshots SET base_id=?, following_json=?, followers_json=? WHERE id=?",
+                    (prev_id, enc[0], enc[1], sid)
+                )
+                since_key += 1
+            else:
+                since_key = 0
+            prev, prev_id = cur, sid
+
+def _migrate_username_ids(c):
+    # v2: словарь никнеймов + снимки как BLOB отсортированных id вместо JSON
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS usernames (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+    """)
+    c.execute("""
+        CREATE TABLE snapshots_v2 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            ts TEXT NOT NULL,
+            base_id INTEGER,
+            following BLOB NOT NULL,
+            followers BLOB NOT NULL
+        );
+    """)
+    # по одной строке отдельным курсором: пишем только в snapshots_v2 и словарь
+    rows = c.connection.execute(
+        "SELECT id, user_id, ts, base_id, following_json, followers_json FROM snapshots ORDER BY id"
+    )
+    for sid, uid, ts, base_id, fwing, fwers in rows:
+        blobs = []
+        for raw in (fwing, fwers):
+            d = json.loads(raw)
+            if base_id is None:
+                ids = _intern(c, d, claim=False)
+                blobs.append(pack_ids(sorted(ids.values())))
+            else:
+                ids = _intern(c, d["+"] + d["-"], claim=False)
+                blobs.append(_encode_delta(sorted(ids[u] for u in d["+"]), sorted(ids[u] for u in d["-"])))
+        c.execute(
+            "INSERT INTO snapshots_v2 (id, user_id, ts, base_id, following, followers) VALUES (?, ?, ?, ?, ?, ?)",
+            (sid, uid, ts, base_id, blobs[0], blobs[1])
+        )
+    c.execute("DROP TABLE snapshots")
+    c.execute("ALTER TABLE snapshots_v2 RENAME TO snapshots")
+
+def _migrate_indexes_and_summary(c):
+    # v3: индексы под горячие запросы + сводка по пользователю, которую поддерживают триггеры
+    c.execute("CREATE INDEX IF NOT EXISTS snapshots_user_id ON snapshots (user_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS snapshots_user_ts ON snapshots (user_id, ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS snapshots_keyframes ON snapshots (user_id, id) WHERE base_id IS NULL")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS user_summary (
+            user_id INTEGER PRIMARY KEY,
+            snap_count INTEGER NOT NULL,
+            last_ts TEXT NOT NULL,
+            last_id INTEGER NOT NULL
+        );
+    """)
+    c.execute("""
+        INSERT INTO user_summary (user_id, snap_count, last_ts, last_id)
+        SELECT user_id, COUNT(*), MAX(ts), MAX(id) FROM snapshots GROUP BY user_id
+    """)
+    c.execute("""
+        CREATE TRIGGER snapshots_summary_ins AFTER INSERT ON snapshots BEGIN
+            INSERT INTO user_summary (user_id, snap_count, last_ts, last_id) VALUES (NEW.user_id, 1, NEW.ts, NEW.id)
+            ON CONFLICT (user_id) DO UPDATE SET
+                snap_count = snap_count + 1,
+                last_ts = MAX(last_ts, NEW.ts),
+                last_id = MAX(last_id, NEW.id);
+        END;
+    """)
+    c.execute("""
+        CREATE TRIGGER snapshots_summary_del AFTER DELETE ON snapshots BEGIN
+            DELETE FROM user_summary WHERE user_id = OLD.user_id AND snap_count <= 1;
+            UPDATE user_summary SET
+                snap_count = snap_count - 1,
+                last_ts = CASE WHEN last_ts = OLD.ts
+                    THEN (SELECT MAX(ts) FROM snapshots WHERE user_id = OLD.user_id) ELSE last_ts END,
+                last_id = CASE WHEN last_id = OLD.id
+                    THEN (SELECT MAX(id) FROM snapshots WHERE user_id = OLD.user_id) ELSE last_id END
+            WHERE user_id = OLD.user_id;
+        END;
+    """)
+
+def _migrate_sessions(c):
+    # v4: незавершённые загрузки (following ждёт followers), вытесненные из памяти
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER PRIMARY KEY,
+            ts TEXT NOT NULL,
+            following BLOB NOT NULL
+        );
+    """)
+
+def _migrate_reports(c):
+    # v5: собранный ZIP-отчёт — ключ (снимок, хэш списков), файл на диске и file_id в Telegram
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS reports (
+            user_id INTEGER PRIMARY KEY,
+            snap_id INTEGER NOT NULL,
+            digest TEXT NOT NULL,
+            path TEXT NOT NULL,
+            file_id TEXT
+        );
+    """)
+
+def _migrate_snapshot_stats(c):
+    # v6: счётчики по каждому снимку для /history; старые строки заполняет backfill_stats()
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS snapshot_stats (
+            snap_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            ts TEXT NOT NULL,
+            followers INTEGER NOT NULL,
+            following INTEGER NOT NULL,
+            mutual INTEGER NOT NULL,
+            new_followers INTEGER,
+            unfollowers INTEGER,
+            new_following INTEGER,
+            unfollowed_by_you INTEGER
+        );
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS snapshot_stats_user ON snapshot_stats (user_id, snap_id)")
+    c.execute("""
+        CREATE TRIGGER snapshots_stats_del AFTER DELETE ON snapshots BEGIN
+            DELETE FROM snapshot_stats WHERE snap_id = OLD.id;
+        END;
+    """)
+
+def _migrate_snapshot_digest(c):
+    # v7: хэш содержимого снимка — повторную загрузку тех же списков видно без восстановления;
+    # у старых строк NULL, для них сравниваются сами массивы
+    c.execute("ALTER TABLE snapshots ADD COLUMN digest TEXT")
+
+def _migrate_name_candidates(c):
+    # v8: никнеймы без ссылок, найденные прошлым проходом sweep_usernames — следующий их удалит
+    c.execute("CREATE TABLE IF NOT EXISTS name_candidates (id INTEGER PRIMARY KEY)")
+
+def _migrate_imported_archives(c):
+    # v9: архивы, которые import_archives.py уже провёл (записал или нашёл совпадающим с прошлым
+    # снимком) — по ним повторный запуск продолжает прерванный импорт
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS imported_archives (
+            user_id INTEGER NOT NULL,
+            ts TEXT NOT NULL,
+            PRIMARY KEY (user_id, ts)
+        ) WITHOUT ROWID
+    """)
+
+# порядок важен: индекс в списке + 1 = PRAGMA user_version после миграции
+MIGRATIONS = [
+    _migrate_delta_storage,
+    _migrate_username_ids,
+    _migrate_indexes_and_summary,
+    _migrate_sessions,
+    _migrate_reports,
+    _migrate_snapshot_stats,
+    _migrate_snapshot_digest,
+    _migrate_name_candidates,
+    _migrate_imported_archives,
+]
 
 def init_db():
-    conn, c = conn_cur()
+    conn = db()
+    c = conn.cursor()
     c.execute("""
         CREATE TABLE IF NOT EXISTS snapshots (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -40,57 +550,395 @@ def init_db():
             followers_json TEXT NOT NULL
         );
     """)
-    conn.commit()
-    conn.close()
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    for i, migrate in enumerate(MIGRATIONS[version:], start=version + 1):
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            migrate(c)
+            c.execute(f"PRAGMA user_version={i}")
+        except BaseException:
+            if conn.in_transaction:
+                c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
 
-def load_last_snapshot(user_id):
-    conn, c = conn_cur()
-    c.execute("SELECT id, ts, following_json, followers_json FROM snapshots WHERE user_id=? ORDER BY id DESC LIMIT 1", (user_id,))
-    row = c.fetchone()
-    conn.close()
-    if not row:
+def _intern(c, names, claim=True):
+    # name -> id для всех names, недостающие добавляются в словарь; claim — снять выданные id
+    # с очереди на удаление (name_candidates, её ещё нет до v8)
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS _names (name TEXT PRIMARY KEY)")
+    c.execute("DELETE FROM _names")
+    c.executemany("INSERT OR IGNORE INTO _names (name) VALUES (?)", ((n,) for n in names))
+    c.execute("INSERT OR IGNORE INTO usernames (name) SELECT name FROM _names")
+    if claim and c.execute("SELECT 1 FROM name_candidates LIMIT 1").fetchone():
+        c.execute("DELETE FROM name_candidates WHERE id IN "
+                  "(SELECT u.id FROM _names t JOIN usernames u ON u.name = t.name)")
+    return dict(c.execute("SELECT u.name, u.id FROM _names t JOIN usernames u ON u.name = t.name"))
+
+def _lookup(c, ids):
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS _ids (id INTEGER PRIMARY KEY)")
+    c.execute("DELETE FROM _ids")
+    c.executemany("INSERT OR IGNORE INTO _ids (id) VALUES (?)", ((i,) for i in ids))
+    return dict(c.execute("SELECT u.id, u.name FROM _ids t JOIN usernames u ON u.id = t.id"))
+
+def _resolve(c, names):
+    # только чтение: name -> id для известных names и те из них, что стоят в name_candidates
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS _names (name TEXT PRIMARY KEY)")
+    c.execute("DELETE FROM _names")
+    c.executemany("INSERT OR IGNORE INTO _names (name) VALUES (?)", ((n,) for n in names))
+    ids, queued = {}, []
+    for name, i, cand in c.execute("SELECT u.name, u.id, nc.id IS NOT NULL FROM _names t JOIN usernames u ON u.name = t.name "
+                                   "LEFT JOIN name_candidates nc ON nc.id = u.id"):
+        ids[name] = i
+        if cand:
+            queued.append(name)
+    return ids, queued
+
+def intern_usernames(names):
+    # писатель нужен только для новых имён и для снятия с очереди на удаление:
+    # повторная загрузка тех же списков обходится одним чтением
+    with read_tx("intern_lookup") as c:
+        ids, queued = _resolve(c, names)
+    rest = [n for n in names if n not in ids] + queued
+    if rest:
+        ids.update(db_write(_intern, rest))
+    return ids
+
+def lookup_usernames(ids):
+    with read_tx("lookup_usernames") as c:
+        return _lookup(c, ids)
+
+def ids_digest(following_ids, followers_ids):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(pack_ids(following_ids))
+    h.update(b"|")
+    h.update(pack_ids(followers_ids))
+    return h.hexdigest()
+
+def _encode_delta(add, rem):
+    return pack_ids([len(add)]) + pack_ids(add) + pack_ids(rem)
+
+def _apply_delta(base, blob):
+    d = unpack_ids(blob)
+    n = d[0]
+    _, rest, _ = merge_diff(base, d[1 + n:])
+    return merge_union(rest, d[1:1 + n])
+
+def _delta_or_none(prev, cur):
+    # prev/cur = (following_ids, followers_ids); None, если дельта не выгоднее полного кадра
+    out, size = [], 0
+    for old, new in zip(prev, cur):
+        _, rem, add = merge_diff(old, new)
+        size += len(add) + len(rem)
+        out.append(_encode_delta(add, rem))
+    if size * 2 > len(cur[0]) + len(cur[1]):
         return None
-    sid, ts, fwing, fwers = row
-    return {
-        "id": sid,
-        "ts": ts,
-        "following": set(json.loads(fwing)),
-        "followers": set(json.loads(fwers))
-    }
+    return out[0], out[1]
 
-def save_snapshot(user_id, following_set, followers_set):
-    # retention: почистим старьё для этого пользователя
-    if RETENTION_DAYS > 0:
-        cleanup_old_snapshots(user_id, RETENTION_DAYS)
+def _key_id(c, user_id, sid):
+    return c.execute(
+        "SELECT MAX(id) FROM snapshots WHERE user_id=? AND id<=? AND base_id IS NULL", (user_id, sid)
+    ).fetchone()[0]
 
-    conn, c = conn_cur()
+def _reconstruct(c, user_id, sid, base=None):
+    # восстановить снимок sid: ближайший ключевой кадр <= sid + все дельты после него;
+    # base — уже восстановленный снимок между этим кадром и sid: тогда только дельты после base
+    key_id = _key_id(c, user_id, sid)
+    if key_id is None:
+        return None
+    following, followers, ts, last_id = array("I"), array("I"), None, None
+    if base and key_id <= base["id"] < sid:
+        key_id, following, followers = base["id"] + 1, base["following"], base["followers"]
+    rows = c.execute(
+        "SELECT id, ts, base_id, following, followers FROM snapshots "
+        "WHERE user_id=? AND id BETWEEN ? AND ? ORDER BY id", (user_id, key_id, sid)
+    ).fetchall()
+    for rid, ts, base_id, fwing, fwers in rows:
+        if base_id is None:
+            following, followers = unpack_ids(fwing), unpack_ids(fwers)
+        else:
+            following = _apply_delta(following, fwing)
+            followers = _apply_delta(followers, fwers)
+        last_id = rid
+    if last_id != sid:
+        return None
+    return {"id": sid, "ts": ts, "following": following, "followers": followers}
+
+def load_snapshot(user_id, sid):
+    # following/followers — отсортированные array('I') id, имена через lookup_usernames;
+    # снимки из кэша общие — массивы не менять
+    with read_tx("load_snapshot") as c:
+        return cached_snapshot(c, user_id, sid)
+
+def load_last_snapshot(user_id):
+    with read_tx("load_last_snapshot") as c:
+        c.execute("SELECT last_id FROM user_summary WHERE user_id=?", (user_id,))
+        row = c.fetchone()
+        return cached_snapshot(c, user_id, row[0]) if row else None
+
+def save_snapshot(user_id, following_ids, followers_ids, prev=None, stats=None):
+    # following_ids/followers_ids — отсортированные массивы id (см. intern_usernames)
+    # prev — уже загруженный последний снимок (если есть), чтобы не восстанавливать его заново;
+    # stats — счётчики относительно prev (snapshot_stats), если diff уже посчитан
     ts = datetime.datetime.utcnow().isoformat()
+    sid = db_write(_save_snapshot_tx, user_id, following_ids, followers_ids, prev, stats, ts)
+    decoded_snapshots.put((user_id, sid), {"id": sid, "ts": ts, "following": following_ids, "followers": followers_ids})
+    return sid
+
+def _save_snapshot_tx(c, user_id, following_ids, followers_ids, prev, stats, ts=None):
+    # retention сюда не входит — этим занимается фоновый retention_sweeper();
+    # ts — время снимка (UTC, isoformat), по умолчанию сейчас; возвращает id новой строки
+    ts = ts or datetime.datetime.utcnow().isoformat()
+    row = c.execute(
+        "SELECT id, (SELECT COUNT(*) FROM snapshots s2 WHERE s2.user_id=s.user_id AND s2.id>"
+        " (SELECT MAX(id) FROM snapshots s3 WHERE s3.user_id=s.user_id AND s3.base_id IS NULL))"
+        " FROM snapshots s WHERE user_id=? ORDER BY id DESC LIMIT 1", (user_id,)
+    ).fetchone()
+    if (prev["id"] if prev else None) != (row[0] if row else None):
+        prev, stats = (_reconstruct(c, user_id, row[0]) if row else None), None
+    base_id, enc = None, None
+    if prev and row[1] < KEYFRAME_EVERY - 1:
+        enc = _delta_or_none((prev["following"], prev["followers"]), (following_ids, followers_ids))
+        base_id = row[0] if enc else None
+    if not enc:
+        enc = pack_ids(following_ids), pack_ids(followers_ids)
     c.execute(
-        "INSERT INTO snapshots (user_id, ts, following_json, followers_json) VALUES (?, ?, ?, ?)",
-        (user_id, ts, json.dumps(sorted(following_set)), json.dumps(sorted(followers_set)))
+        "INSERT INTO snapshots (user_id, ts, base_id, following, followers, digest) VALUES (?, ?, ?, ?, ?, ?)",
+        (user_id, ts, base_id, enc[0], enc[1], ids_digest(following_ids, followers_ids))
     )
-    conn.commit()
-    conn.close()
+    sid = c.lastrowid
+    if stats is None:
+        stats = _stats_for(following_ids, followers_ids, prev)
+    _insert_stats(c, sid, user_id, ts, stats)
+    return sid
 
-def cleanup_old_snapshots(user_id, days):
+def _drop_snapshots(c, user_id, doomed):
+    # удалить снимки так, чтобы уцелевшие дельты не потеряли базу: их переписываем в ключевые кадры
+    doomed = set(doomed)
+    if not doomed:
+        return
+    orphans = []
+    for sid in sorted(doomed):
+        # база дельты — предыдущий по id снимок, значит сирота может быть только следующим
+        nxt = c.execute(
+            "SELECT id, base_id FROM snapshots WHERE user_id=? AND id>? ORDER BY id LIMIT 1", (user_id, sid)
+        ).fetchone()
+        if nxt and nxt[1] == sid and nxt[0] not in doomed:
+            orphans.append(nxt[0])
+    for sid in orphans:
+        snap = _reconstruct(c, user_id, sid)
+        c.execute(
+            "UPDATE snapshots SET base_id=NULL, following=?, followers=? WHERE id=?",
+            (pack_ids(snap["following"]), pack_ids(snap["followers"]), sid)
+        )
+    c.executemany("DELETE FROM snapshots WHERE id=?", [(sid,) for sid in doomed])
+
+def _cleanup_tx(c, user_id, days, limit=-1):
+    # удаляет до limit самых старых просроченных снимков, возвращает сколько удалено
     cutoff = (datetime.datetime.utcnow() - datetime.timedelta(days=days)).isoformat()
-    conn, c = conn_cur()
-    c.execute("DELETE FROM snapshots WHERE user_id=? AND ts<?", (user_id, cutoff))
-    conn.commit()
-    conn.close()
+    doomed = [r[0] for r in c.execute(
+        "SELECT id FROM snapshots WHERE user_id=? AND ts<? ORDER BY ts LIMIT ?", (user_id, cutoff, limit)
+    ).fetchall()]
+    _drop_snapshots(c, user_id, doomed)
+    return len(doomed)
 
-def wipe_user_history(user_id):
-    conn, c = conn_cur()
+def retention_sweeper():
+    # фоновый поток: раз в RETENTION_SWEEP_SEC удаляет просроченные снимки пачками по RETENTION_BATCH,
+    # чтобы ни одна транзакция не держала писателя долго
+    while True:
+        try:
+            users = [r[0] for r in read_all("retention_users", "SELECT user_id FROM user_summary")]
+            for uid in users:
+                while db_write(_cleanup_tx, uid, RETENTION_DAYS, RETENTION_BATCH) == RETENTION_BATCH:
+                    time.sleep(0.05)
+        except Exception as e:
+            print(f"retention sweep failed: {e!r}")
+        time.sleep(RETENTION_SWEEP_SEC)
+
+def start_retention_sweeper():
+    if RETENTION_DAYS > 0:
+        threading.Thread(target=retention_sweeper, name="retention", daemon=True).start()
+
+# ---------- Username sweep ----------
+# Словарь usernames общий, поэтому /wipe и retention удаляют только снимки, а осиротевшие имена
+# убирает sweep_usernames. Id без ссылок из снимков (ключевых кадров и дельт) и сессий
+# сначала попадают в name_candidates, удаляются следующим проходом, если ссылок так и не
+# появилось. Между проходами _intern снимает с очереди каждое имя, которое снова выдаёт, —
+# так не пропадает имя, уже вернувшееся загрузке, но ещё не записанное в снимок. Строка
+# с наибольшим id не удаляется никогда, поэтому id не переиспользуются и кэши в памяти не
+# получат по старому id чужое имя.
+def _blob_ids(rows, ids):
+    # rows: (following, followers, base_id); у дельты первый элемент — длина добавлений, не id
+    for fwing, fwers, base_id in rows:
+        for blob in (fwing, fwers):
+            a = unpack_ids(blob)
+            ids.update(a if base_id is None else a[1:])
+    return ids
+
+def _sweep_usernames_tx(c, unused, last_sid):
+    # то, что записано после чтения в sweep_usernames, своих имён не теряет
+    used = _blob_ids(c.execute("SELECT following, followers, base_id FROM snapshots WHERE id>?", (last_sid,)), set())
+    for (blob,) in c.execute("SELECT following FROM sessions"):
+        used.update(unpack_ids(blob))
+    top = c.execute("SELECT MAX(id) FROM usernames").fetchone()[0] or 0
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS _unused (id INTEGER PRIMARY KEY)")
+    c.execute("DELETE FROM _unused")
+    c.executemany("INSERT INTO _unused (id) VALUES (?)", ((i,) for i in unused if i not in used and i < top))
+    n = c.execute("DELETE FROM usernames WHERE id IN (SELECT id FROM name_candidates JOIN _unused USING (id))").rowcount
+    c.execute("DELETE FROM name_candidates")
+    c.execute("INSERT INTO name_candidates (id) SELECT id FROM _unused WHERE id IN (SELECT id FROM usernames)")
+    return n
+
+def sweep_usernames():
+    # -> сколько имён удалено; весь проход чтения — в одном снимке WAL, писатель занят только удалением
+    with read_tx("sweep_usernames") as c:
+        last_sid = c.execute("SELECT COALESCE(MAX(id), 0) FROM snapshots").fetchone()[0]
+        used = _blob_ids(c.execute("SELECT following, followers, base_id FROM snapshots"), set())
+        for (blob,) in c.execute("SELECT following FROM sessions"):
+            used.update(unpack_ids(blob))
+        unused = [i for (i,) in c.execute("SELECT id FROM usernames") if i not in used]
+    return db_write(_sweep_usernames_tx, unused, last_sid)
+
+def names_sweeper():
+    while True:
+        time.sleep(NAMES_SWEEP_SEC)
+        try:
+            sweep_usernames()
+        except Exception as e:
+            print(f"username sweep failed: {e!r}")
+
+def start_names_sweeper():
+    if NAMES_SWEEP_SEC > 0:
+        threading.Thread(target=names_sweeper, name="names-sweep", daemon=True).start()
+
+def _wipe_tx(c, user_id):
     c.execute("DELETE FROM snapshots WHERE user_id=?", (user_id,))
-    conn.commit()
-    conn.close()
+    c.execute("DELETE FROM user_summary WHERE user_id=?", (user_id,))
+    c.execute("DELETE FROM imported_archives WHERE user_id=?", (user_id,))
+    return _drop_report_tx(c, user_id)
+
+def wipe_user_history(user_id):
+    _remove_report_file(db_write(_wipe_tx, user_id))
 
 def get_user_stats(user_id):
-    conn, c = conn_cur()
-    c.execute("SELECT COUNT(*), MAX(ts) FROM snapshots WHERE user_id=?", (user_id,))
-    count, last_ts = c.fetchone()
-    conn.close()
-    return (count or 0), last_ts
+    row = read_one("user_stats", "SELECT snap_count, last_ts FROM user_summary WHERE user_id=?", (user_id,))
+    return row if row else (0, None)
+
+def get_last_digest(user_id):
+    # (digest, ts) последнего снимка; digest = None у снимков до v7
+    row = read_one(
+        "last_digest",
+        "SELECT s.digest, s.ts FROM user_summary u JOIN snapshots s ON s.id = u.last_id WHERE u.user_id=?", (user_id,)
+    )
+    return row if row else (None, None)
+
+def get_last_snapshot_id(user_id):
+    row = read_one("last_snapshot_id", "SELECT last_id FROM user_summary WHERE user_id=?", (user_id,))
+    return row[0] if row else 0
+
+def get_report(user_id):
+    return read_one("get_report", "SELECT snap_id, digest, path, file_id FROM reports WHERE user_id=?", (user_id,))
+
+def _save_report_tx(c, user_id, snap_id, digest, path, file_id):
+    old = _drop_report_tx(c, user_id)
+    c.execute("INSERT INTO reports (user_id, snap_id, digest, path, file_id) VALUES (?, ?, ?, ?, ?)",
+              (user_id, snap_id, digest, path, file_id))
+    return old if old != path else None
+
+def _drop_report_tx(c, user_id):
+    row = c.execute("SELECT path FROM reports WHERE user_id=?", (user_id,)).fetchone()
+    c.execute("DELETE FROM reports WHERE user_id=?", (user_id,))
+    return row[0] if row else None
+
+def _remove_report_file(path):
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def save_report(user_id, snap_id, digest, path, file_id):
+    _remove_report_file(db_write(_save_report_tx, user_id, snap_id, digest, path, file_id))
+
+def invalidate_report(user_id):
+    _remove_report_file(db_write(_drop_report_tx, user_id))
+
+# ---------- Snapshot stats ----------
+# Счётчики снимка считаются при записи (diff уже есть) и лежат в snapshot_stats — /history
+# читает их одним запросом по индексу, не восстанавливая снимки.
+STAT_COLUMNS = ("followers", "following", "mutual", "new_followers", "unfollowers", "new_following", "unfollowed_by_you")
+STATS_BACKFILL_BATCH = 200
+
+def snapshot_stats(count, n_following, n_followers, has_prev):
+    # count(key) — длина списка из diff_lists; без прошлого снимка new/lost неизвестны (NULL)
+    return (n_followers, n_following, count("mutual")) + tuple(count(k) if has_prev else None for k in STAT_COLUMNS[3:])
+
+def _stats_for(following_ids, followers_ids, prev):
+    # только счётчики — на множествах быстрее, чем полный diff_lists (он строит сами списки)
+    fwing, fwers = set(following_ids), set(followers_ids)
+    n = {"mutual": len(fwing & fwers)}
+    if prev:
+        p_fwing, p_fwers = set(prev["following"]), set(prev["followers"])
+        n.update(new_followers=len(fwers - p_fwers), unfollowers=len(p_fwers - fwers),
+                 new_following=len(fwing - p_fwing), unfollowed_by_you=len(p_fwing - fwing))
+    return snapshot_stats(n.get, len(following_ids), len(followers_ids), prev is not None)
+
+def _insert_stats(c, snap_id, user_id, ts, stats):
+    c.execute(
+        f"INSERT OR REPLACE INTO snapshot_stats (snap_id, user_id, ts, {', '.join(STAT_COLUMNS)}) "
+        f"VALUES (?, ?, ?{', ?' * len(STAT_COLUMNS)})", (snap_id, user_id, ts) + tuple(stats)
+    )
+
+def _insert_stats_tx(c, rows):
+    for r in rows:
+        _insert_stats(c, *r)
+
+def get_history(user_id, limit):
+    # новые сверху: (ts, followers, following, mutual, new_followers, unfollowers, new_following, unfollowed_by_you)
+    return read_all(
+        "get_history",
+        f"SELECT ts, {', '.join(STAT_COLUMNS)} FROM snapshot_stats WHERE user_id=? ORDER BY snap_id DESC LIMIT ?",
+        (user_id, limit)
+    )
+
+def backfill_stats():
+    # снимки без строки в snapshot_stats (записаны до v6): проходим пользователя подряд по id,
+    # восстанавливая каждый снимок из предыдущего одной дельтой, и пишем пачками
+    users = [r[0] for r in read_all(
+        "backfill_users",
+        "SELECT DISTINCT s.user_id FROM snapshots s LEFT JOIN snapshot_stats st ON st.snap_id = s.id "
+        "WHERE st.snap_id IS NULL"
+    )]
+    done = 0
+    for uid in users:
+        rows = []
+        with read_tx("backfill_stats") as c:
+            have = set(r[0] for r in c.execute("SELECT snap_id FROM snapshot_stats WHERE user_id=?", (uid,)))
+            prev = None
+            for sid, ts, base_id, fwing, fwers in c.execute(
+                "SELECT id, ts, base_id, following, followers FROM snapshots WHERE user_id=? ORDER BY id", (uid,)
+            ):
+                if base_id is None:
+                    cur = {"id": sid, "following": unpack_ids(fwing), "followers": unpack_ids(fwers)}
+                else:
+                    cur = {"id": sid, "following": _apply_delta(prev["following"], fwing),
+                           "followers": _apply_delta(prev["followers"], fwers)}
+                if sid not in have:
+                    rows.append((sid, uid, ts, _stats_for(cur["following"], cur["followers"], prev)))
+                prev = cur
+        for i in range(0, len(rows), STATS_BACKFILL_BATCH):
+            db_write(_insert_stats_tx, rows[i:i + STATS_BACKFILL_BATCH])
+        done += len(rows)
+    return done
+
+def start_stats_backfill():
+    def run():
+        try:
+            n = backfill_stats()
+            if n:
+                print(f"snapshot stats backfilled: {n}")
+        except Exception as e:
+            print(f"stats backfill failed: {e!r}")
+    threading.Thread(target=run, name="stats-backfill", daemon=True).start()
 
 # ---------- Access control ----------
 def is_allowed_user(update: Update):
@@ -101,113 +949,729 @@ def is_allowed_user(update: Update):
 
 def ensure_allowed(update: Update):
     if not is_allowed_user(update):
-        update.effective_message.reply_text("⛔️ Доступ ограничён.")
+        reply(update, "⛔️ Доступ ограничён.")
         return False
     return True
 
 # ---------- ZIP parsing ----------
-class SimpleHTMLUserParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.users = set()
-    def handle_data(self, data):
-        s = data.strip()
-        if s and len(s) <= 50 and (" " not in s or s.count(" ") <= 1):
-            if re.match(r"^[A-Za-z0-9._]+$", s):
-                self.users.add(s.lower())
-
-def parse_zip_for_users(b: bytes):
-    following = set()
-    followers = set()
-    with zipfile.ZipFile(io.BytesIO(b), 'r') as z:
-        for name in z.namelist():
-            lower = name.lower()
+# Архив не держим в памяти: документ качается во временный файл, из ZIP читаются
+# только подходящие члены, и каждый разбирается потоково кусками по ZIP_CHUNK.
+ZIP_CHUNK = 1 << 16
+ZIP_PARALLEL_MIN_BYTES = 4 << 20  # с какого распакованного объёма члены разбираются параллельно (parse_zip_parallel)
+MEMBER_EXTS = (".json", ".html", ".htm")
+MEMBER_HINTS = ("follow", "relationship", "connections")  # фото/видео/переписки даже не распаковываем
+FOLLOWERS_KEYS = {"followers", "relationships_followers"}
+FOLLOWING_KEYS = {"following", "relationships_following"}
+
+def download_to_tempfile(doc, suffix=""):
+    # путь к временному файлу; удалить его — забота вызывающего
+    f = doc.get_file()
+    fd, path = tempfile.mkstemp(prefix="igbot_", suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            if os.path.isfile(f.file_path):  # локальный Bot API сервер отдаёт путь на диске
+                with open(f.file_path, "rb") as src:
+                    shutil.copyfileobj(src, out, ZIP_CHUNK)
+            else:
+                with urllib.request.urlopen(f.file_path, timeout=60) as resp:
+                    shutil.copyfileobj(resp, out, ZIP_CHUNK)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+def file_digest(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(TEXT_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+_JSON_WS = re.compile(r"[ \t\r\n]*")
+_JSON_NUM_CHARS = frozenset("0123456789.eE+-")
+
+class JsonStream:
+    # Потоковый разбор верхнего уровня JSON: массивы перебираются поэлементно,
+    # каждый элемент декодируется json.raw_decode — в памяти только он и кусок буфера.
+    def __init__(self, fp, encoding="utf-8", chunk=ZIP_CHUNK):
+        self.fp = fp
+        self.chunk = chunk
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.raw_decode = json.JSONDecoder().raw_decode
+        self.buf, self.pos, self.eof = "", 0, False
+
+    def _fill(self, size=None):
+        chunk = self.fp.read(size or self.chunk)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + self.decoder.decode(chunk, final=self.eof)
+        self.pos = 0
+
+    def peek(self):
+        # следующий значимый символ, '' — конец потока
+        while True:
+            self.pos = _JSON_WS.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if self.eof:
+                return ""
+            self._fill()
+
+    def value(self):
+        size = self.chunk
+        self.peek()
+        while True:
             try:
-                raw = z.read(name)
-            except:
+                obj, end = self.raw_decode(self.buf, self.pos)
+                # число на границе буфера могло обрезаться (в том числе после '.' или 'e') —
+                # принимаем, только если за ним уже идёт символ, которым число продолжиться не может
+                if self.eof or not isinstance(obj, (int, float)) or (
+                        end < len(self.buf) and self.buf[end] not in _JSON_NUM_CHARS):
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            size *= 2  # большой элемент: дочитываем всё крупнее, чтобы не уйти в квадрат
+            self._fill(size)
+
+    def _expect_sep(self, close):
+        ch = self.peek()
+        self.pos += 1
+        if ch == close:
+            return False
+        if ch != ",":
+            raise ValueError(f"JSON: ожидалось ',' или {close!r}")
+        return True
+
+    def _array(self):
+        self.pos += 1
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if not self._expect_sep("]"):
+                return
+
+    def items(self):
+        # (ключ верхнего уровня или None, значение, элемент_списка?)
+        ch = self.peek()
+        if ch == "[":
+            for x in self._array():
+                yield None, x, True
+        elif ch == "{":
+            self.pos += 1
+            if self.peek() == "}":
+                self.pos += 1
+                return
+            while True:
+                key = self.value()
+                if self.peek() != ":":
+                    raise ValueError("JSON: ожидалось ':'")
+                self.pos += 1
+                if self.peek() == "[":
+                    for x in self._array():
+                        yield key, x, True
+                else:
+                    yield key, self.value(), False
+                if not self._expect_sep("}"):
+                    return
+        else:
+            yield None, self.value(), False
+
+def _item_username(item):
+    if not isinstance(item, dict):
+        return None
+    u = item.get("username")
+    if not u:
+        sld = item.get("string_list_data")
+        if isinstance(sld, list) and sld and isinstance(sld[0], dict):
+            u = sld[0].get("value")
+    return u.strip().lower() if isinstance(u, str) and u.strip() else None
+
+def _walk_users(x, followers, following):
+    # общий обходчик для незнакомых файлов: один проход сразу по обоим наборам ключей
+    if isinstance(x, dict):
+        for k, v in x.items():
+            if isinstance(v, list):
+                kl = k.lower()
+                target = followers if kl in FOLLOWERS_KEYS else following if kl in FOLLOWING_KEYS else None
+                if target is not None:
+                    for item in v:
+                        u = _item_username(item)
+                        if u:
+                            target.add(u)
+            if isinstance(v, (dict, list)):
+                _walk_users(v, followers, following)
+    elif isinstance(x, list):
+        for it in x:
+            if isinstance(it, (dict, list)):
+                _walk_users(it, followers, following)
+
+def _generic_item(key, x, in_list, followers, following):
+    if key is not None and in_list:
+        kl = key.lower()
+        u = _item_username(x)
+        if u and kl in FOLLOWERS_KEYS:
+            followers.add(u)
+        if u and kl in FOLLOWING_KEYS:
+            following.add(u)
+    elif key is not None:
+        x = {key: x}
+    _walk_users(x, followers, following)
+
+def extract_generic(stream, followers, following):
+    for key, x, in_list in stream.items():
+        _generic_item(key, x, in_list, followers, following)
+
+# Известные раскладки выгрузки Instagram:
+#   followers_1.json, followers_2.json, ... — список записей или {"relationships_followers": [...]}
+#   following.json — {"relationships_following": [...]}
+# запись: {"title": ..., "string_list_data": [{"href": ..., "value": <username>, "timestamp": ...}]}
+KNOWN_JSON_RE = re.compile(r"(?:^|/)(followers(?:_\d+)?|following)\.json$")
+_HREF_USER_RE = re.compile(r"instagram\.com/(?:_u/)?([A-Za-z0-9._]+)")
+
+def known_json_kind(name):
+    m = KNOWN_JSON_RE.search(name.lower())
+    if not m:
+        return None
+    return "following" if m.group(1) == "following" else "followers"
+
+def _known_item_username(item):
+    # value, в новых выгрузках following бывает только title или href
+    try:
+        sld = item["string_list_data"][0]
+        u = sld.get("value") or item.get("title")
+        if not u:
+            m = _HREF_USER_RE.search(sld.get("href") or "")
+            u = m and m.group(1)
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return _item_username(item)
+    return u.strip().lower() if isinstance(u, str) and u.strip() else None
+
+def extract_known(stream, kind, followers, following):
+    # один проход: записи ожидаемого списка сразу в нужный набор, всё прочее — общим обходчиком
+    target, keys = (followers, FOLLOWERS_KEYS) if kind == "followers" else (following, FOLLOWING_KEYS)
+    for key, x, in_list in stream.items():
+        if in_list and (key is None or key.lower() in keys):
+            u = _known_item_username(x)
+            if u:
+                target.add(u)
                 continue
+        _generic_item(key, x, in_list, followers, following)
 
-            if lower.endswith(".json"):
-                data = None
-                for enc in ("utf-8", "latin-1"):
-                    try:
-                        data = json.loads(raw.decode(enc))
-                        break
-                    except:
-                        pass
-                if data is None:
-                    continue
-
-                def collect_from(obj, key_candidates):
-                    result = set()
-                    def walk(x):
-                        if isinstance(x, dict):
-                            for k,v in x.items():
-                                kl = k.lower()
-                                if kl in key_candidates and isinstance(v, list):
-                                    for item in v:
-                                        if isinstance(item, dict):
-                                            u = item.get("username")
-                                            if not u:
-                                                sld = item.get("string_list_data")
-                                                if isinstance(sld, list) and sld:
-                                                    u = sld[0].get("value")
-                                            if u:
-                                                result.add(u.strip().lower())
-                                walk(v)
-                        elif isinstance(x, list):
-                            for it in x:
-                                walk(it)
-                    walk(obj)
-                    return result
-
-                followers |= collect_from(data, {"followers", "relationships_followers"})
-                following |= collect_from(data, {"following", "relationships_following"})
-
-            elif lower.endswith(".html") or lower.endswith(".htm"):
-                try:
-                    html = raw.decode("utf-8", errors="ignore")
-                    p = SimpleHTMLUserParser()
-                    p.feed(html)
-                    if "follower" in lower:
-                        followers |= p.users
-                    elif "following" in lower:
-                        following |= p.users
-                    else:
-                        followers |= p.users
-                        following |= p.users
-                except:
-                    continue
+def _parse_json_member(z, info, followers, following):
+    kind = known_json_kind(info.filename)
+    for enc in ("utf-8", "latin-1"):
+        fw, fg = set(), set()
+        try:
+            with z.open(info) as fp:
+                stream = JsonStream(fp, enc)
+                if kind:
+                    extract_known(stream, kind, fw, fg)
+                else:
+                    extract_generic(stream, fw, fg)
+        except Exception:
+            continue
+        followers |= fw
+        following |= fg
+        return
+
+def _parse_html_member(z, info):
+    dec = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+    with z.open(info) as fp:
+        chunks = (dec.decode(chunk) for chunk in iter(functools.partial(fp.read, ZIP_CHUNK), b""))
+        return extract_html_users(chunks, info.filename)
+
+def _zip_members(z):
+    infos = [i for i in z.infolist() if not i.is_dir() and i.filename.lower().endswith(MEMBER_EXTS)]
+    hinted = [i for i in infos if any(h in i.filename.lower() for h in MEMBER_HINTS)]
+    return hinted or infos
+
+def _parse_member(z, info, followers, following):
+    if info.filename.lower().endswith(".json"):
+        _parse_json_member(z, info, followers, following)
+        return
+    try:
+        kind, users = _parse_html_member(z, info)
+    except Exception:
+        return
+    if kind == "followers":
+        followers |= users
+    elif kind == "following":
+        following |= users
+
+def parse_zip_for_users(src):
+    # src — путь к архиву, открытый файл или bytes
+    if isinstance(src, (bytes, bytearray)):
+        src = io.BytesIO(src)
+    following = set()
+    followers = set()
+    with zipfile.ZipFile(src, 'r') as z:
+        for info in _zip_members(z):
+            _parse_member(z, info, followers, following)
+    return sorted(following), sorted(followers)
+
+def parse_zip_member(path, name):
+    # один член архива в процессе пула: (followers, following) строками через \n —
+    # одна большая строка пиклится в разы быстрее множества из сотен тысяч маленьких
+    followers, following = set(), set()
+    with zipfile.ZipFile(path) as z:
+        _parse_member(z, z.getinfo(name), followers, following)
+    return "\n".join(followers), "\n".join(following)
+
+def parse_zip_parallel(path):
+    # Большие многочастные выгрузки (followers_1.json, followers_2.json, ...): каждый член —
+    # отдельная задача пула, самые большие первыми; частичные множества сливаются здесь.
+    # Маленький или одночастный архив целиком уходит одной задачей (меньше IPC).
+    with zipfile.ZipFile(path) as z:
+        infos = sorted(_zip_members(z), key=lambda i: -i.file_size)
+    if _cpu_pool is None or len(infos) < 2 or sum(i.file_size for i in infos) < ZIP_PARALLEL_MIN_BYTES:
+        return run_cpu(parse_zip_for_users, path)
+    following, followers = set(), set()
+    for fw, fg in run_cpu_many(parse_zip_member, [(path, i.filename) for i in infos]):
+        if fw:
+            followers.update(fw.split("\n"))
+        if fg:
+            following.update(fg.split("\n"))
     return sorted(following), sorted(followers)
 
+# ---------- HTML parsing ----------
+# В HTML-выгрузке каждый аккаунт — ссылка на профиль instagram.com/<user>. Берём только эти
+# ссылки одной скомпилированной регуляркой (без разбора DOM и текстовых узлов с датами и
+# подписями). Тип файла определяется один раз — по имени или по <title>; чужие страницы пропускаем.
+KNOWN_HTML_RE = re.compile(r"(?:^|/)(followers(?:_\d+)?|following)\.html?$")
+_HTML_PROFILE_RE = re.compile(
+    r"""<a\s[^>]*?href\s*=\s*["']?(?:https?:)?//(?:www\.)?instagram\.com/(?:_u/)?([A-Za-z0-9._]{1,30})/?(?=["'?#\s>])""",
+    re.I,
+)
+_HTML_TITLE_RE = re.compile(r"<title[^>]*>\s*([^<]*?)\s*</title>", re.I)
+HTML_TITLES = (("followers", "followers"), ("following", "following"),
+               ("подписчики", "followers"), ("подписки", "following"))
+_NOT_PROFILES = {"accounts", "explore", "p", "reel", "reels", "stories", "direct", "about", "legal", "developer"}
+HTML_HEAD_LIMIT = 64 * 1024  # если за столько символов нет <title>, тип не узнаём
+
+def html_kind(name, head=""):
+    m = KNOWN_HTML_RE.search(name.lower())
+    if m:
+        return "following" if m.group(1) == "following" else "followers"
+    m = _HTML_TITLE_RE.search(head)
+    title = m.group(1).strip().lower() if m else ""
+    return next((kind for prefix, kind in HTML_TITLES if title.startswith(prefix)), None)
+
+def extract_html_users(chunks, name=""):
+    # (kind, users); kind=None — файл не про подписки, его содержимое не нужно
+    kind = html_kind(name)
+    users, buf = set(), ""
+    for chunk in chunks:
+        buf += chunk
+        if kind is None:
+            if "</title>" not in buf.lower() and len(buf) < HTML_HEAD_LIMIT:
+                continue
+            kind = html_kind(name, buf)
+            if kind is None:
+                return None, set()
+        # тег на границе куска не режем: всё после последнего '<' ждёт следующий кусок
+        cut = buf.rfind("<")
+        if cut > 0:
+            users.update(map(str.lower, _HTML_PROFILE_RE.findall(buf, 0, cut)))
+            buf = buf[cut:]
+    if kind is None:
+        kind = html_kind(name, buf)
+        if kind is None:
+            return None, set()
+    users.update(map(str.lower, _HTML_PROFILE_RE.findall(buf)))
+    users.difference_update(_NOT_PROFILES)
+    return kind, users
+
 # ---------- Plain text parsing ----------
-USERNAME_RE = re.compile(r'@?([A-Za-z0-9](?:[A-Za-z0-9._]{0,28}[A-Za-z0-9])?)')
+# Текст разбирается кусками по TEXT_CHUNK: кусок режется по последнему разделителю,
+# недочитанный токен переносится в следующий. Совпадение регулярки уже начинается и
+# заканчивается буквой/цифрой и не длиннее 30, так что нормализация — только lower().
+TEXT_CHUNK = 1 << 20
+USERNAME_RE = re.compile(r'@?([A-Za-z0-9][A-Za-z0-9._]{0,28}[A-Za-z0-9])')
+_TOKEN_CHARS = string.ascii_letters + string.digits + "._@"
+USERNAME_COLUMNS = {"username", "user_name", "user", "login", "instagram", "account", "ник", "никнейм"}
+
+def tokenize_users(chunks):
+    out = set()
+    tail = ""
+    for chunk in chunks:
+        buf = tail + chunk
+        cut = len(buf.rstrip(_TOKEN_CHARS))
+        out.update(map(str.lower, USERNAME_RE.findall(buf, 0, cut)))
+        tail = buf[cut:]
+    out.update(map(str.lower, USERNAME_RE.findall(tail)))
+    out.difference_update([u for u in out if u.isdigit()])
+    return out
+
 def to_user_set(text: str):
-    candidates = USERNAME_RE.findall(text)
-    norm = []
-    for c in candidates:
-        u = c.strip('.').strip('_').lower()
-        if 2 <= len(u) <= 30 and not u.isdigit():
-            norm.append(u)
-    seen, out = set(), []
-    for u in norm:
-        if u not in seen:
-            seen.add(u)
-            out.append(u)
-    return set(out)
+    return tokenize_users(text[i:i + TEXT_CHUNK] for i in range(0, len(text), TEXT_CHUNK))
+
+def _cell_username(cell):
+    m = _HREF_USER_RE.search(cell)
+    m = USERNAME_RE.search(m.group(1) if m else cell)
+    u = m.group(1).lower() if m else None
+    return u if u and not u.isdigit() else None
+
+def _users_from_csv(f):
+    # только колонка с никнеймом (по заголовку); None — колонку не узнали
+    sample = f.read(64 * 1024)
+    f.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(f, dialect)
+    header = next(reader, None) or []
+    cols = [h.strip().lstrip("@").lower() for h in header]
+    idx = next((i for i, h in enumerate(cols) if h in USERNAME_COLUMNS), None)
+    if idx is None:
+        return None
+    out = set()
+    for row in reader:
+        if idx < len(row):
+            u = _cell_username(row[idx])
+            if u:
+                out.add(u)
+    return out
+
+def read_user_file(path, csv_mode=False):
+    # .txt/.csv с диска потоково; None — не удалось прочитать
+    for enc in ("utf-8-sig", "latin-1"):
+        try:
+            with open(path, encoding=enc, newline="") as f:
+                if csv_mode:
+                    users = _users_from_csv(f)
+                    if users is not None:
+                        return users
+                    f.seek(0)
+                return tokenize_users(iter(functools.partial(f.read, TEXT_CHUNK), ""))
+        except UnicodeDecodeError:
+            continue
+    return None
+
+# ---------- Cache ----------
+def approx_size(obj):
+    # грубая оценка памяти: контейнер + строки/элементы первого уровня
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(approx_size(v) for v in obj.values())
+    if isinstance(obj, (list, set, frozenset, tuple)):
+        return sys.getsizeof(obj) + sum(map(sys.getsizeof, obj))
+    return sys.getsizeof(obj)
+
+class LRUCache:
+    # Потокобезопасный LRU с TTL и бюджетом памяти. Бюджет соблюдается при put(),
+    # просроченное выметает фоновый поток (start_cache_sweeper).
+    def __init__(self, max_bytes, ttl_sec):
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.bytes = 0
+        self._items = OrderedDict()  # key -> (value, size, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            if item[2] < time.monotonic():
+                self._remove(key)
+                return default
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value):
+        size = approx_size(value)
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (value, size, time.monotonic() + self.ttl_sec)
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self._items) > 1:
+                self._remove(next(iter(self._items)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            self._remove(key)
+            return item[0]
+
+    def sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, (_, _, exp) in self._items.items() if exp < now]:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, size, _ = self._items.pop(key)
+        self.bytes -= size
+
+_caches = []
+
+def _expire_sessions_tx(c):
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(minutes=SESSION_TTL_MIN)).isoformat()
+    c.execute("DELETE FROM sessions WHERE ts<?", (cutoff,))
+
+def start_cache_sweeper():
+    def loop():
+        while True:
+            time.sleep(CACHE_SWEEP_SEC)
+            for cache in _caches:
+                cache.sweep()
+            try:
+                db_write(_expire_sessions_tx)
+            except Exception as e:
+                print(f"session sweep failed: {e!r}")
+    threading.Thread(target=loop, name="cache-sweeper", daemon=True).start()
+
+# ---------- Outbound ----------
+# Все ответы бота идут через outbox: у каждого чата своя очередь (порядок сообщений сохраняется),
+# отправку ограничивают токен-бакеты на чат и общий. Ожидающий вызов с тем же key заменяется
+# новым (частые клики «Ещё» по одному сообщению дадут одну правку). На RetryAfter чат встаёт
+# на паузу, а вызов возвращается в начало его очереди. Без start_outbox() (бенчмарки, скрипты)
+# вызов выполняется сразу в текущем потоке.
+class _Bucket:
+    __slots__ = ("rate", "cap", "tokens", "at")
+    def __init__(self, rate, cap):
+        self.rate, self.cap, self.tokens, self.at = rate, cap, cap, time.monotonic()
+
+    def wait(self, now):
+        # сколько ждать до следующего токена
+        self.tokens = min(self.cap, self.tokens + (now - self.at) * self.rate)
+        self.at = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+class Outbox:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # chat_id -> deque([key, fn, args, kwargs, fut, t0])
+        self._buckets = {}
+        self._paused = {}  # chat_id -> monotonic(), до которого чат ждёт после RetryAfter
+        self._busy = set()  # чаты, чей вызов сейчас выполняется
+        self._global = _Bucket(OUT_GLOBAL_RATE, OUT_GLOBAL_RATE)
+        self._threads = []
+
+    def start(self, senders, rate=OUT_GLOBAL_RATE):
+        self._global = _Bucket(rate, rate)
+        for i in range(senders):
+            t = threading.Thread(target=self._loop, name=f"outbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, chat_id, fn, *args, key=None, **kwargs):
+        fut = Future()
+        if not self._threads:
+            try:
+                fut.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                fut.set_exception(e)
+            return fut
+        with self._cond:
+            q = self._queues.get(chat_id)
+            if q is None:
+                q = self._queues[chat_id] = deque()
+            if key is not None:
+                for job in q:
+                    if job[0] == key:
+                        job[1], job[2], job[3] = fn, args, kwargs
+                        inc("igbot_outbox_coalesced_total")
+                        return job[4]
+            q.append([key, fn, args, kwargs, fut, time.monotonic()])
+            self._cond.notify()
+        return fut
+
+    def _pick(self, now):
+        # (chat_id, job) первого чата, которому можно слать, или (None, сколько ждать)
+        delay = None
+        g = self._global.wait(now)
+        for chat, q in self._queues.items():
+            if chat in self._busy:
+                continue
+            b = self._buckets.get(chat)
+            if b is None:
+                b = self._buckets[chat] = _Bucket(OUT_CHAT_RATE, OUT_CHAT_BURST)
+            w = max(self._paused.get(chat, 0) - now, b.wait(now), g)
+            if w <= 0:
+                job = q.popleft()
+                if q:
+                    self._queues.move_to_end(chat)  # по кругу, чтобы длинная очередь не держала остальных
+                else:
+                    del self._queues[chat]
+                b.tokens -= 1
+                self._global.tokens -= 1
+                self._busy.add(chat)
+                return chat, job
+            delay = w if delay is None else min(delay, w)
+        return None, delay
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    chat, job = self._pick(time.monotonic())
+                    if chat is not None:
+                        break
+                    self._cond.wait(job)
+                if len(self._buckets) > 10000:
+                    for c in [c for c in self._buckets if c not in self._queues and c not in self._busy]:
+                        del self._buckets[c]
+            self._run(chat, job)
+
+    def _run(self, chat, job):
+        key, fn, args, kwargs, fut, t0 = job
+        observe("igbot_outbox_wait_seconds", time.monotonic() - t0)
+        retry = None
+        try:
+            fut.set_result(fn(*args, **kwargs))
+        except RetryAfter as e:
+            retry = e.retry_after
+        except Exception as e:
+            fut.set_exception(e)
+        with self._cond:
+            self._busy.discard(chat)
+            if retry is None:
+                self._paused.pop(chat, None)
+            else:
+                inc("igbot_outbox_retry_after_total")
+                self._paused[chat] = time.monotonic() + retry
+                self._global.tokens = min(self._global.tokens, 0)
+                q = self._queues.get(chat)
+                if q is None:
+                    q = self._queues[chat] = deque()
+                q.appendleft(job)
+            self._cond.notify_all()
+
+outbox = Outbox()
+
+def start_outbox(processes=1):
+    # лимит Bot API общий на токен: процессы webhook-режима делят его поровну
+    outbox.start(OUT_SENDERS, OUT_GLOBAL_RATE / processes)
+
+def _report_failure(fut):
+    e = fut.exception()
+    if e is not None:
+        print(f"send failed: {e!r}")
+
+def reply(update: Update, text, key=None, **kwargs):
+    # ответ в чат апдейта через outbox; Future с отправленным Message
+    msg = update.effective_message
+    fut = outbox.submit(msg.chat_id, msg.reply_text, text, key=key, **kwargs)
+    fut.add_done_callback(_report_failure)
+    return fut
+
+def reply_document(update: Update, **kwargs):
+    msg = update.effective_message
+    fut = outbox.submit(msg.chat_id, msg.reply_document, **kwargs)
+    fut.add_done_callback(_report_failure)
+    return fut
+
+def edit_or_reply(update: Update, text, **kwargs):
+    # правка сообщения с нажатой кнопкой; если править нельзя — новое сообщение
+    msg = update.effective_message
+    def run():
+        try:
+            return msg.edit_text(text, **kwargs)
+        except BadRequest as e:
+            if "not modified" in str(e):
+                return msg
+            return msg.reply_text(text, **kwargs)
+    fut = outbox.submit(msg.chat_id, run, key=("edit", msg.message_id))
+    fut.add_done_callback(_report_failure)
+    return fut
 
 # ---------- Pagination state ----------
-store_lists = {}  # uid -> dict of lists for pagination
-def chunk(lst, start, size): return lst[start:start+size]
+class DiffResult:
+    # Результат сравнения для кнопок. Массивы id (diff_lists) есть сразу — из них счётчики для
+    # сводки и меню; имена и сортировка — только для списка, который впервые открыли.
+    # Дороже всего — поиск имён в словаре, поэтому открытый список сразу сортируется и хранится
+    # целиком: «Ещё» и повторные открытия его только режут.
+    def __init__(self, ids):
+        self._ids = {k: ids.get(k, array("I")) for k in LIST_KEYS}
+        self._names = {}
+        self._names_bytes = 0
+        self._digest = None
+        self._lock = threading.Lock()
+
+    def count(self, key):
+        ids = self._ids.get(key)
+        return len(ids) if ids is not None else 0
+
+    def page(self, key, start, size):
+        return self.get(key)[start:start + size]
+
+    def get(self, key, default=None):
+        if key not in self._ids:
+            return default
+        with self._lock:
+            names = self._names.get(key)
+            if names is None:
+                names = self._names[key] = sorted(self._resolve(key))
+                self._names_bytes += approx_size(names)
+        return names
+
+    def digest(self):
+        # хэш содержимого всех списков — вторая половина ключа готового отчёта
+        if self._digest is None:
+            h = hashlib.blake2b(digest_size=8)
+            for k in LIST_KEYS:
+                h.update(k.encode())
+                h.update(pack_ids(self._ids[k]))
+            self._digest = h.hexdigest()
+        return self._digest
+
+    def report_lists(self):
+        return [(fname, self._ids[key]) for fname, key in REPORT_FILES]
+
+    def _resolve(self, key):
+        ids = self._ids[key]
+        return lookup_usernames(ids).values() if ids else ()
 
-def build_keyboard(prefix, start, total, extra_row=True):
+    def __sizeof__(self):
+        return object.__sizeof__(self) + sum(a.buffer_info()[1] * a.itemsize for a in self._ids.values()) + self._names_bytes
+
+# uid -> DiffResult для кнопок; после вытеснения/рестарта пересобирается из снимков (get_lists);
+# (uid, old_id, new_id) -> сравнение двух снимков из /compare (get_comparison)
+store_lists = LRUCache(CACHE_MAX_MB * 1024 * 1024 // 2, CACHE_TTL_MIN * 60)
+_caches.append(store_lists)
+
+def get_lists(uid):
+    data = store_lists.get(uid)
+    if data is None:
+        data = rebuild_lists(uid)
+        if data is not None:
+            store_lists.put(uid, data)
+    return data
+
+def get_comparison(uid, old_id, new_id):
+    # снимки могли удалить (retention, /wipe) — тогда и готовое сравнение больше не показываем
+    key = (uid, old_id, new_id)
+    with read_tx("compare") as c:
+        if c.execute("SELECT COUNT(*) FROM snapshots WHERE user_id=? AND id IN (?, ?)", (uid, old_id, new_id)).fetchone()[0] < 2:
+            store_lists.pop(key, None)
+            return None
+        data = store_lists.get(key)
+        if data is not None:
+            return data
+        old, new = cached_snapshot(c, uid, old_id), cached_snapshot(c, uid, new_id)
+    with timed("igbot_stage_seconds", stage="diff"):
+        data = DiffResult(run_cpu(diff_lists, new["following"], new["followers"], old["following"], old["followers"]))
+    store_lists.put(key, data)
+    return data
+
+def build_keyboard(prefix, start, total, extra_row=True, cmp=None):
+    # cmp = (old_id, new_id): страница сравнения, «назад» ведёт к его сводке
+    back = f"cmp|{cmp[0]}|{cmp[1]}" if cmp else "menu"
     row = []
     next_start = start + PAGE_SIZE
     if next_start < total:
-        row.append(InlineKeyboardButton(f"Ещё ({next_start}/{total})", callback_data=f"page|{prefix}|{next_start}"))
-    row.append(InlineKeyboardButton("⬅️ К спискам", callback_data="menu"))
+        page = f"{back}|{prefix}" if cmp else f"page|{prefix}"
+        row.append(InlineKeyboardButton(f"Ещё ({next_start}/{total})", callback_data=f"{page}|{next_start}"))
+    row.append(InlineKeyboardButton("⬅️ К сравнению" if cmp else "⬅️ К спискам", callback_data=back))
     rows = [row]
-    if extra_row:
+    if extra_row and not cmp:
         rows.append([
             InlineKeyboardButton("📥 Скачать ZIP отчёт", callback_data="download_zip"),
             InlineKeyboardButton("ℹ️ Туториал", callback_data="howto"),
@@ -217,13 +1681,14 @@ def build_keyboard(prefix, start, total, extra_row=True):
         ])
     return InlineKeyboardMarkup(rows)
 
-def send_page(update: Update, context: CallbackContext, uid: int, list_key: str, start: int):
-    data = store_lists.get(uid, {})
-    items = data.get(list_key, [])
-    total = len(items)
-    page = chunk(items, start, PAGE_SIZE)
+def send_page(update: Update, context: CallbackContext, uid: int, list_key: str, start: int, edit=False, cmp=None):
+    data = get_comparison(uid, *cmp) if cmp else get_lists(uid)
+    total = data.count(list_key) if data else 0
+    page = data.page(list_key, start, PAGE_SIZE) if start < total else []
+    if data:
+        store_lists.put((uid,) + cmp if cmp else uid, data)  # размер записи мог вырасти после материализации списка
     if not page:
-        update.effective_message.reply_text("Пока тут пусто.")
+        reply(update, "Пока тут пусто.")
         return
     title_map = {
         "mutual": "🤝 Взаимные",
@@ -238,14 +1703,18 @@ def send_page(update: Update, context: CallbackContext, uid: int, list_key: str,
     }
     title = title_map.get(list_key, list_key)
     text = f"{title} ({start+1}-{min(start+PAGE_SIZE, total)} из {total}):\n" + "\n".join(page)
-    kb = build_keyboard(list_key, start, total)
-    update.effective_message.reply_text(text, reply_markup=kb)
+    kb = build_keyboard(list_key, start, total, cmp=cmp)
+    if edit:
+        edit_or_reply(update, text, reply_markup=kb)
+    else:
+        reply(update, text, reply_markup=kb)
 
-def show_menu(update: Update, context: CallbackContext, uid: int):
-    data = store_lists.get(uid, {})
+MENU_TEXT = "Выберите список:"
+
+def list_rows(data, prefix="page"):
     def btn(label, key):
-        count = len(data.get(key, []))
-        return InlineKeyboardButton(f"{label} ({count})", callback_data=f"page|{key}|0")
+        count = data.count(key) if data else 0
+        return InlineKeyboardButton(f"{label} ({count})", callback_data=f"{prefix}|{key}|0")
     row1 = [
         btn("🤝 Взаимные", "mutual"),
         btn("➡️ Только в following", "only_in_following"),
@@ -263,6 +1732,9 @@ def show_menu(update: Update, context: CallbackContext, uid: int):
         btn("✨ Стали взаимными", "new_mutuals"),
         btn("💔 Потеряли взаимность", "lost_mutuals"),
     ]
+    return [row1, row2, row3, row4]
+
+def show_menu(update: Update, context: CallbackContext, uid: int, text=MENU_TEXT, edit=False):
     row5 = [
         InlineKeyboardButton("📥 Скачать ZIP отчёт", callback_data="download_zip"),
         InlineKeyboardButton("ℹ️ Туториал", callback_data="howto"),
@@ -270,15 +1742,55 @@ def show_menu(update: Update, context: CallbackContext, uid: int):
     row6 = [
         InlineKeyboardButton("🗑 Очистить историю", callback_data="ask_wipe"),
     ]
-    kb = InlineKeyboardMarkup([row1, row2, row3, row4, row5, row6])
-    update.effective_message.reply_text("Выберите список:", reply_markup=kb)
+    kb = InlineKeyboardMarkup(list_rows(get_lists(uid)) + [row5, row6])
+    if edit:
+        edit_or_reply(update, text, reply_markup=kb)
+    else:
+        reply(update, text, reply_markup=kb, key="menu" if text == MENU_TEXT else None)
+
+def show_comparison(update: Update, context: CallbackContext, uid: int, old_id: int, new_id: int, edit=False):
+    # сводка из счётчиков: имена списков подтянутся, только когда список откроют
+    data = get_comparison(uid, old_id, new_id)
+    if data is None:
+        reply(update, "Этих снимков уже нет. Посмотрите доступные в /history.")
+        return
+    def sizes(sid):
+        row = read_one(
+            "compare_sizes",
+            "SELECT s.ts, st.followers, st.following FROM snapshots s "
+            "LEFT JOIN snapshot_stats st ON st.snap_id = s.id WHERE s.user_id=? AND s.id=?", (uid, sid)
+        )
+        if row and row[1] is None:  # счётчики снимка ещё не досчитаны (backfill_stats)
+            snap = load_snapshot(uid, sid)
+            row = (row[0], len(snap["followers"]), len(snap["following"]))
+        return row
+    (old_ts, old_fwers, old_fwing), (new_ts, new_fwers, new_fwing) = sizes(old_id), sizes(new_id)
+    n = data.count
+    text = (
+        f"🔍 Сравнение снимков\n{old_ts[:16].replace('T', ' ')} → {new_ts[:16].replace('T', ' ')} UTC\n\n"
+        f"• followers: {old_fwers} → {new_fwers}\n"
+        f"• following: {old_fwing} → {new_fwing}\n\n"
+        f"• 🟢 новые подписчики: {n('new_followers')}\n"
+        f"• 🔴 отписались: {n('unfollowers')}\n"
+        f"• ➕ вы зафолловили: {n('new_following')}\n"
+        f"• ➖ вы отписались: {n('unfollowed_by_you')}\n"
+        f"• ✨ стали взаимными: {n('new_mutuals')}\n"
+        f"• 💔 потеряли взаимность: {n('lost_mutuals')}"
+    )
+    kb = InlineKeyboardMarkup(list_rows(data, f"cmp|{old_id}|{new_id}")[1:] + [[
+        InlineKeyboardButton("⬅️ К спискам", callback_data="menu"),
+    ]])
+    if edit:
+        edit_or_reply(update, text, reply_markup=kb)
+    else:
+        reply(update, text, reply_markup=kb)
 
 # ---------- Bot texts ----------
 HELP = (
 "Пришлите *архив Instagram (.zip)* из «Download your information» — я сам извлеку списки.\n"
 "Либо пришлите подряд два сообщения/файла: сначала *following*, затем *followers* (можно просто вставить текст из браузера — я извлеку никнеймы).\n"
 "Покажу сводку и изменения, а подробные списки — по кнопкам.\n"
-"/delete — сбросить незавершённую загрузку, /wipe — удалить историю, /stats — статистика, /howto — как получить списки."
+"/delete — сбросить незавершённую загрузку, /wipe — удалить историю, /stats — статистика, /history — динамика по снимкам, /compare — сравнить любые два снимка, /howto — как получить списки."
 )
 
 HOWTO = textwrap.dedent("""
@@ -312,29 +1824,259 @@ HOWTO = textwrap.dedent("""
 """).strip()
 
 # ---------- Session state ----------
-# user_stage[uid] = {"following": set or None, "followers": set or None, "ts": datetime}
-user_stage = {}
+# user_stage[uid] = {"following": set, "ts": datetime} — принятый following, ждём followers.
+# Сессия сразу пишется в таблицу sessions: после вытеснения из памяти, рестарта или на другом
+# процессе-воркере она поднимается оттуда при следующем сообщении.
 def session_is_stale(info):
     if not info or "ts" not in info: return True
     age = datetime.datetime.utcnow() - info["ts"]
     return age.total_seconds() > SESSION_TTL_MIN * 60
 
+def _spill_session_tx(c, uid, following, ts):
+    ids = _intern(c, following)
+    c.execute(
+        "INSERT OR REPLACE INTO sessions (user_id, ts, following) VALUES (?, ?, ?)",
+        (uid, ts.isoformat(), pack_ids(sorted(ids.values())))
+    )
+
+user_stage = LRUCache(CACHE_MAX_MB * 1024 * 1024 // 4, SESSION_TTL_MIN * 60)
+_caches.append(user_stage)
+
+def get_stage(uid):
+    st = user_stage.get(uid)
+    if st is not None:
+        return st
+    row = read_one("get_stage", "SELECT ts, following FROM sessions WHERE user_id=?", (uid,))
+    if not row:
+        return None
+    st = {"following": set(lookup_usernames(unpack_ids(row[1])).values()),
+          "ts": datetime.datetime.fromisoformat(row[0])}
+    if session_is_stale(st):
+        drop_stage(uid)
+        return None
+    return st
+
+def set_stage(uid, following):
+    st = {"following": following, "ts": datetime.datetime.utcnow()}
+    db_write(_spill_session_tx, uid, following, st["ts"])
+    user_stage.put(uid, st)
+
+def _drop_session_tx(c, uid):
+    c.execute("DELETE FROM sessions WHERE user_id=?", (uid,))
+
+def drop_stage(uid):
+    user_stage.pop(uid, None)
+    db_write(_drop_session_tx, uid)
+
+# ---------- Upload dedup ----------
+# Разобранные загрузки по хэшу содержимого: uid -> {ключ: результат}, последние UPLOAD_CACHE_PER_USER.
+# ZIP -> (following_ids, followers_ids) после intern, текст/файл со списком -> frozenset имён.
+# Ключ документа — хэш файла плюс псевдоним "fu:<file_unique_id>" -> хэш, чтобы пересланный
+# тот же файл не приходилось даже скачивать.
+UPLOAD_CACHE_PER_USER = 4
+parsed_uploads = LRUCache(CACHE_MAX_MB * 1024 * 1024 // 8, CACHE_TTL_MIN * 60)
+_caches.append(parsed_uploads)
+
+def cached_upload(uid, key):
+    entries = parsed_uploads.get(uid) or {}
+    hit = entries.get(key)
+    if isinstance(hit, str):  # псевдоним file_unique_id -> хэш файла
+        hit = entries.get(hit)
+    return hit
+
+def cache_upload(uid, key, value, alias=None):
+    entries = dict(parsed_uploads.get(uid) or {})
+    for k, v in ((key, value), (alias, key)):
+        if k:
+            entries.pop(k, None)
+            entries[k] = v
+    while len(entries) > UPLOAD_CACHE_PER_USER:
+        entries.pop(next(iter(entries)))
+    parsed_uploads.put(uid, entries)
+
+# ---------- Decoded snapshots ----------
+# Восстановленные снимки: (user_id, snap_id) -> {"id", "ts", "following", "followers"}. id снимков
+# не переиспользуются (AUTOINCREMENT), а содержимое снимка не меняется — запись не устаревает.
+# Свежий снимок кладёт save_snapshot, так что следующая загрузка, кнопки и /compare берут его
+# без чтения блобов; снимок рядом с закешированным восстанавливается только дельтами после него.
+decoded_snapshots = LRUCache(CACHE_MAX_MB * 1024 * 1024 // 8, CACHE_TTL_MIN * 60)
+_caches.append(decoded_snapshots)
+
+def cached_snapshot(c, user_id, sid):
+    snap = decoded_snapshots.get((user_id, sid))
+    if snap is not None:
+        return snap
+    key_id = _key_id(c, user_id, sid)
+    if key_id is None:
+        return None
+    base = None
+    for (bid,) in c.execute(
+        "SELECT id FROM snapshots WHERE user_id=? AND id>=? AND id<? ORDER BY id DESC", (user_id, key_id, sid)
+    ).fetchall():
+        base = decoded_snapshots.get((user_id, bid))
+        if base is not None:
+            break
+    snap = _reconstruct(c, user_id, sid, base)
+    if snap is not None:
+        decoded_snapshots.put((user_id, sid), snap)
+    return snap
+
+# ---------- Workers ----------
+# Разбор архивов, больших текстов, diff и сборка отчёта уходят в пул процессов,
+# чтобы не держать GIL потоков диспетчера. Тяжёлые обработчики ограничены:
+# не больше MAX_HEAVY_JOBS одновременно, следующие ждут в очереди до HEAVY_WAIT_SEC (отказ —
+# только если очередь полна или ожидание вышло), задачи одного пользователя — по порядку
+# поступления (билеты issue_ticket).
+_cpu_pool = None  # поднимается в main(); без пула (бенчмарки, импорт) всё считается в текущем потоке
+_cpu_pool_lock = threading.Lock()
+
+def start_cpu_pool():
+    global _cpu_pool
+    if CPU_WORKERS > 0:
+        _cpu_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def run_cpu(fn, *args):
+    return run_cpu_many(fn, [args])[0]
+
+def run_cpu_many(fn, arglist):
+    # fn(*args) для каждого args параллельно в пуле; результаты в том же порядке
+    pool = _cpu_pool
+    if pool is None:
+        return [fn(*args) for args in arglist]
+    futs = [pool.submit(fn, *args) for args in arglist]
+    try:
+        return [f.result() for f in futs]
+    except BrokenProcessPool:
+        # процесс упал (например, OOM на гигантском архиве) — пересоздаём пул для следующих задач
+        with _cpu_pool_lock:
+            if _cpu_pool is pool:
+                pool.shutdown(wait=False)
+                start_cpu_pool()
+        raise
+    finally:
+        for f in futs:
+            f.cancel()
+
+_jobs_lock = threading.Lock()
+_jobs_cond = threading.Condition(_jobs_lock)
+_heavy_slots = threading.BoundedSemaphore(MAX_HEAVY_JOBS)
+_jobs_running = 0
+_jobs_waiting = 0
+_user_jobs = {}  # uid -> _UserQueue, пока у пользователя есть невыполненные билеты
+_tickets = {}    # update_id -> билет, выданный issue_ticket
+
+class _UserQueue:
+    # билеты тяжёлых задач пользователя: выполняются строго по номерам, serving — чей ход;
+    # done — завершённые раньше своей очереди (отказ, таймаут), их ход пропускается
+    __slots__ = ("next", "serving", "done", "jobs")
+    def __init__(self):
+        self.next = self.serving = self.jobs = 0
+        self.done = set()
+
+def _take_ticket(uid):
+    # под _jobs_lock
+    q = _user_jobs.get(uid)
+    if q is None:
+        q = _user_jobs[uid] = _UserQueue()
+    q.next += 1
+    return q.next - 1
+
+def _finish_ticket(uid, q, ticket):
+    # под _jobs_lock
+    q.done.add(ticket)
+    while q.serving in q.done:
+        q.done.discard(q.serving)
+        q.serving += 1
+    if q.serving == q.next:
+        _user_jobs.pop(uid, None)
+    _jobs_cond.notify_all()
+
+def issue_ticket(update: Update, context: CallbackContext):
+    # синхронно в потоке диспетчера, в порядке поступления: run_async раздаёт обновления разным
+    # потокам, и только номер, взятый здесь, сохраняет порядок (following, потом followers)
+    if update.effective_user is None or not is_allowed_user(update):
+        return
+    for h in context.dispatcher.handlers.get(0, ()):
+        check = h.check_update(update)
+        if check is not None and check is not False:  # как Dispatcher: первый подходящий в группе
+            if getattr(h.callback, "heavy", False):
+                with _jobs_lock:
+                    _tickets[update.update_id] = _take_ticket(update.effective_user.id)
+            return
+
+@contextmanager
+def heavy_job(uid, ticket=None):
+    # сначала очередь пользователя (ход его билета), потом общий слот; ждущие в MAX_HEAVY_JOBS не
+    # считаются. Без билета из issue_ticket номер берётся здесь — порядок тогда по времени вызова
+    global _jobs_running, _jobs_waiting
+    with _jobs_lock:
+        if ticket is None:
+            ticket = _take_ticket(uid)
+        q = _user_jobs[uid]
+        admitted = _jobs_waiting < HEAVY_QUEUE_LIMIT + MAX_HEAVY_JOBS - _jobs_running and q.jobs < USER_QUEUE_LIMIT
+        if admitted:
+            _jobs_waiting += 1
+            q.jobs += 1
+        else:
+            _finish_ticket(uid, q, ticket)
+    if not admitted:
+        yield False
+        return
+    running = False
+    try:
+        deadline = time.monotonic() + HEAVY_WAIT_SEC
+        with _jobs_cond:
+            turn = _jobs_cond.wait_for(lambda: q.serving == ticket, HEAVY_WAIT_SEC)
+        running = turn and _heavy_slots.acquire(timeout=max(0, deadline - time.monotonic()))
+        with _jobs_lock:
+            _jobs_waiting -= 1
+            if running:
+                _jobs_running += 1
+        yield running
+    finally:
+        if running:
+            _heavy_slots.release()
+        with _jobs_lock:
+            if running:
+                _jobs_running -= 1
+            q.jobs -= 1
+            _finish_ticket(uid, q, ticket)
+
+BUSY_TEXT = "⏳ Сейчас обрабатываю много загрузок. Пришлите, пожалуйста, ещё раз через минуту."
+
+def heavy(handler):
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext):
+        if not is_allowed_user(update):
+            return handler(update, context)
+        with _jobs_lock:
+            ticket = _tickets.pop(update.update_id, None)
+        with heavy_job(update.effective_user.id, ticket) as admitted:
+            if not admitted:
+                inc("igbot_busy_rejections_total")
+                reply(update, BUSY_TEXT)
+                return
+            return handler(update, context)
+    wrapper.heavy = True  # по нему issue_ticket узнаёт тяжёлый обработчик
+    return wrapper
+
 # ---------- Callbacks & Commands ----------
+@metered
 def start(update: Update, context: CallbackContext):
     if not ensure_allowed(update): return
-    update.message.reply_text(
-        "Привет! Я покажу взаимные подписки и изменения со временем.\n\n" + HELP,
-        parse_mode="Markdown"
-    )
+    reply(update, "Привет! Я покажу взаимные подписки и изменения со временем.\n\n" + HELP, parse_mode="Markdown")
 
+@metered
 def help_cmd(update: Update, context: CallbackContext):
     if not ensure_allowed(update): return
-    update.message.reply_text(HELP, parse_mode="Markdown")
+    reply(update, HELP, parse_mode="Markdown")
 
+@metered
 def howto_cmd(update: Update, context: CallbackContext):
     if not ensure_allowed(update): return
-    update.message.reply_text(HOWTO)
+    reply(update, HOWTO)
 
+@metered
 def stats_cmd(update: Update, context: CallbackContext):
     if not ensure_allowed(update): return
     uid = update.effective_user.id
@@ -342,14 +2084,104 @@ def stats_cmd(update: Update, context: CallbackContext):
     txt = f"📊 Снимков сохранено: {cnt}\nПоследний: {last_ts or '—'}"
     if RETENTION_DAYS > 0:
         txt += f"\nRetention: храню до {RETENTION_DAYS} дн."
-    update.message.reply_text(txt)
+    reply(update, txt)
+
+HISTORY_LIMIT = 30
+HISTORY_MAX = 1000
 
+def _signed(new, lost):
+    return "" if new is None else f" (+{new}/−{lost})"
+
+@metered
+def history_cmd(update: Update, context: CallbackContext):
+    if not ensure_allowed(update): return
+    uid = update.effective_user.id
+    try:
+        limit = min(max(int(context.args[0]), 1), HISTORY_MAX) if context.args else HISTORY_LIMIT
+    except ValueError:
+        limit = HISTORY_LIMIT
+    rows = get_history(uid, limit)
+    if not rows:
+        reply(update, "История пуста: пришлите ZIP или списки, чтобы сохранить первый снимок.")
+        return
+    lines = [
+        f"{ts[:16].replace('T', ' ')}  👥 {fwers}{_signed(new_fwers, lost_fwers)}  ➡️ {fwing}{_signed(new_fwing, lost_fwing)}  🤝 {mutual}"
+        for ts, fwers, fwing, mutual, new_fwers, lost_fwers, new_fwing, lost_fwing in rows
+    ]
+    text = f"🕓 Последние снимки ({len(rows)}), новые сверху:\n" + "\n".join(lines)
+    if len(text) <= 3500:
+        reply(update, text)
+        return
+    sio = io.StringIO()
+    w = csv.writer(sio)
+    w.writerow(("ts",) + STAT_COLUMNS)
+    w.writerows(reversed(rows))
+    reply_document(update, document=InputFile(io.BytesIO(sio.getvalue().encode("utf-8")), filename="history.csv"),
+                   caption=f"🕓 История: {len(rows)} снимков.")
+
+COMPARE_HELP = (
+"Сравню два сохранённых снимка:\n"
+"/compare 90d — последний снимок с тем, что был 90 дней назад (можно 2w, 3m, 1y)\n"
+"/compare 2024-05-01 — с последним снимком на эту дату\n"
+"/compare 3 — с 3-м снимком назад (1 — предыдущий)\n"
+"/compare 2024-05-01 2024-08-01 — два снимка между собой\n"
+"Даты снимков — в /history."
+)
+AGO_DAYS = {"d": 1, "w": 7, "m": 30, "y": 365}
+
+def resolve_snapshot(c, uid, ref):
+    # "now", N снимков назад, 90d/2w/3m/1y назад, YYYY-MM-DD -> id снимка; если нужного нет
+    # (раньше начала истории) — самый ранний. None — ссылку не разобрали
+    ref = ref.strip().lower()
+    m = re.fullmatch(r"(\d+)([dwmy])", ref)
+    if ref in ("now", "last") or ref.isdigit():
+        row = c.execute("SELECT id FROM snapshots WHERE user_id=? ORDER BY id DESC LIMIT 1 OFFSET ?",
+                        (uid, 0 if not ref.isdigit() else int(ref))).fetchone()
+    else:
+        if m:
+            cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=int(m.group(1)) * AGO_DAYS[m.group(2)])
+        else:
+            try:
+                cutoff = datetime.date.fromisoformat(ref) + datetime.timedelta(days=1)
+            except ValueError:
+                return None
+        row = c.execute("SELECT id FROM snapshots WHERE user_id=? AND ts<? ORDER BY ts DESC, id DESC LIMIT 1",
+                        (uid, cutoff.isoformat())).fetchone()
+    if row is None:
+        row = c.execute("SELECT MIN(id) FROM snapshots WHERE user_id=?", (uid,)).fetchone()
+    return row[0]
+
+@metered
+@heavy
+def compare_cmd(update: Update, context: CallbackContext):
+    if not ensure_allowed(update): return
+    uid = update.effective_user.id
+    if not context.args:
+        reply(update, COMPARE_HELP)
+        return
+    if get_user_stats(uid)[0] < 2:
+        reply(update, "Для сравнения нужно хотя бы два сохранённых снимка.")
+        return
+    refs = context.args[:2] if len(context.args) > 1 else [context.args[0], "now"]
+    with read_tx("compare") as c:
+        ids = [resolve_snapshot(c, uid, r) for r in refs]
+    if None in ids:
+        reply(update, "Не понял, какие снимки сравнить.\n\n" + COMPARE_HELP)
+        return
+    old_id, new_id = sorted(ids)
+    if old_id == new_id:
+        reply(update, "Это один и тот же снимок — выберите более ранний, даты есть в /history.")
+        return
+    show_comparison(update, context, uid, old_id, new_id)
+
+@metered
 def delete_cmd(update: Update, context: CallbackContext):
     if not ensure_allowed(update): return
     uid = update.effective_user.id
-    user_stage.pop(uid, None)
-    update.message.reply_text("Ок, текущая незавершённая загрузка сброшена. Можно начать заново.")
+    drop_stage(uid)
+    reply(update, "Ок, текущая незавершённая загрузка сброшена. Можно начать заново.")
 
+@metered
 def handle_callback(update: Update, context: CallbackContext):
     if not ensure_allowed(update): return
     uid = update.effective_user.id
@@ -358,33 +2190,63 @@ def handle_callback(update: Update, context: CallbackContext):
     data = cq.data or ""
 
     if data == "menu":
-        show_menu(update, context, uid)
+        show_menu(update, context, uid, edit=True)
         return
     if data == "howto":
-        update.effective_message.reply_text(HOWTO)
+        reply(update, HOWTO)
         return
     if data == "ask_wipe":
         kb = InlineKeyboardMarkup([[
             InlineKeyboardButton("✅ Да, удалить историю", callback_data="wipe_confirm"),
             InlineKeyboardButton("❌ Отмена", callback_data="menu"),
         ]])
-        update.effective_message.reply_text("Удалить все сохранённые снимки для этого чата?", reply_markup=kb)
+        reply(update, "Удалить все сохранённые снимки для этого чата?", reply_markup=kb)
         return
     if data == "wipe_confirm":
         wipe_user_history(uid)
         store_lists.pop(uid, None)
-        update.effective_message.reply_text("Готово. История удалена. Начните заново: пришлите ZIP или списки.")
+        parsed_uploads.pop(uid, None)
+        reply(update, "Готово. История удалена. Начните заново: пришлите ZIP или списки.")
         return
     if data == "download_zip":
-        send_current_zip(update, context, uid)
+        with heavy_job(uid) as admitted:
+            if not admitted:
+                reply(update, BUSY_TEXT)
+                return
+            send_current_zip(update, context, uid)
+        return
+
+    m = re.match(r"^cmp\|(\d+)\|(\d+)(?:\|([^|]+)\|(\d+))?$", data)
+    if m:
+        cmp = (int(m.group(1)), int(m.group(2)))
+        if m.group(3):
+            # как у обычных списков: сводку сравнения оставляем, «Ещё» листает ту же страницу
+            start = int(m.group(4))
+            send_page(update, context, uid, m.group(3), start, edit=start > 0, cmp=cmp)
+        else:
+            show_comparison(update, context, uid, *cmp, edit=True)
         return
 
     m = re.match(r"^page\|([^|]+)\|(\d+)$", data)
     if m:
         key = m.group(1)
         start = int(m.group(2))
-        send_page(update, context, uid, key, start)
+        # «Ещё» листает ту же страницу, кнопка чистого меню превращает его в страницу;
+        # меню под сводкой не трогаем, чтобы сводка осталась в чате
+        send_page(update, context, uid, key, start, edit=start > 0 or cq.message.text == MENU_TEXT)
+        return
+
+def metrics_cmd(update: Update, context: CallbackContext):
+    if str(update.effective_user.id) not in ADMIN_IDS:
         return
+    if not METRICS_ENABLED:
+        reply(update, "Метрики выключены (METRICS=1 в .env).")
+        return
+    text = render_metrics()
+    if len(text) > 3500:
+        reply_document(update, document=InputFile(io.BytesIO(text.encode("utf-8")), filename="metrics.txt"))
+    else:
+        reply(update, text)
 
 def read_text_from_message(update: Update):
     msg = update.message
@@ -394,6 +2256,8 @@ def read_text_from_message(update: Update):
         return msg.text
     return None
 
+@metered
+@heavy
 def handle_document(update: Update, context: CallbackContext):
     if not ensure_allowed(update): return
     uid = update.effective_user.id
@@ -401,35 +2265,61 @@ def handle_document(update: Update, context: CallbackContext):
     if not doc: return
     fname = (doc.file_name or "").lower()
 
+    alias = "fu:" + doc.file_unique_id if doc.file_unique_id else None
+    hit = cached_upload(uid, alias) if alias else None
+    digest = None
+    if hit is None:
+        with timed("igbot_stage_seconds", stage="download"):
+            path = download_to_tempfile(doc, suffix=".zip" if fname.endswith(".zip") else "")
+        digest = file_digest(path)
+        hit = cached_upload(uid, digest)
+        if hit is not None:
+            os.remove(path)
+    if hit is not None:
+        inc("igbot_dedup_total", kind="upload")
+        if isinstance(hit, tuple):
+            process_ids_and_reply(update, context, uid, *hit)
+        else:
+            handle_user_set(update, context, uid, set(hit))
+        return
+
     # ZIP из Instagram
     if fname.endswith(".zip"):
-        f = doc.get_file()
-        bio = io.BytesIO()
-        f.download(out=bio)
-        b = bio.getvalue()
-        following_list, followers_list = parse_zip_for_users(b)
+        inc("igbot_uploads_total", kind="zip")
+        if METRICS_ENABLED:
+            inc("igbot_bytes_ingested_total", os.path.getsize(path), kind="zip")
+        try:
+            with timed("igbot_stage_seconds", stage="parse_zip"):
+                following_list, followers_list = parse_zip_parallel(path)
+        except zipfile.BadZipFile:
+            following_list, followers_list = [], []
+        finally:
+            os.remove(path)
         if not following_list and not followers_list:
-            update.message.reply_text("Не нашёл списки в ZIP. Убедитесь, что это архив из Instagram Download (лучше JSON).")
+            reply(update, "Не нашёл списки в ZIP. Убедитесь, что это архив из Instagram Download (лучше JSON).")
             return
-        A, B = set(following_list), set(followers_list)
-        process_sets_and_reply(update, context, uid, A, B)
+        a, b = intern_sets(following_list, followers_list)
+        cache_upload(uid, digest, (a, b), alias)
+        process_ids_and_reply(update, context, uid, a, b)
         return
 
     # Иначе пробуем как текст/CSV
-    f = doc.get_file()
-    bio = io.BytesIO()
-    f.download(out=bio); bio.seek(0)
-    text = None
-    for enc in ("utf-8", "latin-1"):
-        try:
-            text = bio.read().decode(enc); break
-        except:
-            bio.seek(0)
-    if text is None:
-        update.message.reply_text("Не удалось прочитать документ. Пришлите .txt/.csv или ZIP из Instagram.")
+    inc("igbot_uploads_total", kind="document")
+    if METRICS_ENABLED:
+        inc("igbot_bytes_ingested_total", os.path.getsize(path), kind="document")
+    try:
+        with timed("igbot_stage_seconds", stage="parse_text"):
+            users = run_cpu(read_user_file, path, fname.endswith(".csv"))
+    finally:
+        os.remove(path)
+    if users is None:
+        reply(update, "Не удалось прочитать документ. Пришлите .txt/.csv или ZIP из Instagram.")
         return
-    handle_text_lists(update, context, uid, text)
+    cache_upload(uid, digest, frozenset(users), alias)
+    handle_user_set(update, context, uid, users)
 
+@metered
+@heavy
 def handle_text(update: Update, context: CallbackContext):
     if not ensure_allowed(update): return
     uid = update.effective_user.id
@@ -438,140 +2328,356 @@ def handle_text(update: Update, context: CallbackContext):
     handle_text_lists(update, context, uid, text)
 
 def handle_text_lists(update: Update, context: CallbackContext, uid: int, text: str):
-    # Режим «два текста»: сначала following, затем followers
-    st = user_stage.get(uid)
-    if not st or session_is_stale(st):
-        st = {"following": None, "followers": None, "ts": datetime.datetime.utcnow()}
-        user_stage[uid] = st
+    inc("igbot_uploads_total", kind="text")
+    if METRICS_ENABLED:
+        inc("igbot_bytes_ingested_total", len(text.encode("utf-8")), kind="text")
+    digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+    s = cached_upload(uid, digest)
+    if s is not None:
+        inc("igbot_dedup_total", kind="text")
+        s = set(s)
+    else:
+        with timed("igbot_stage_seconds", stage="parse_text"):
+            s = run_cpu(to_user_set, text) if len(text) >= CPU_OFFLOAD_MIN_CHARS else to_user_set(text)
+        cache_upload(uid, digest, frozenset(s))
+    handle_user_set(update, context, uid, s)
 
-    s = to_user_set(text)
-    if st["following"] is None:
-        st["following"] = s
-        st["ts"] = datetime.datetime.utcnow()
-        update.message.reply_text(f"Принял *following* ({len(s)}). Теперь пришлите *followers*.", parse_mode="Markdown")
+def handle_user_set(update: Update, context: CallbackContext, uid: int, s: set):
+    # Режим «два текста»: сначала following, затем followers
+    st = get_stage(uid)
+    if st is None:
+        set_stage(uid, s)
+        reply(update, f"Принял *following* ({len(s)}). Теперь пришлите *followers*.", parse_mode="Markdown")
         return
 
-    if st["followers"] is None:
-        st["followers"] = s
-        A, B = st["following"], st["followers"]
-        process_sets_and_reply(update, context, uid, A, B)
-        user_stage.pop(uid, None)
+    process_sets_and_reply(update, context, uid, st["following"], s)
+    drop_stage(uid)
 
 # ---------- Report / ZIP ----------
-def build_zip_bytes_from_lists(lists_dict):
-    def to_csv_bytes(rows, header="username"):
-        sio = io.StringIO()
-        w = csv.writer(sio)
-        w.writerow([header])
-        for r in rows: w.writerow([r])
-        return sio.getvalue().encode("utf-8")
-
-    zbuf = io.BytesIO()
-    with zipfile.ZipFile(zbuf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for fname, rows in lists_dict.items():
-            zf.writestr(fname, to_csv_bytes(rows))
-    zbuf.seek(0); zbuf.name = "report.zip"
-    return zbuf
+# Отчёт собирается один раз на снимок: в процессе пула, потоково прямо в файл на диске.
+# Ключ — (id последнего снимка, хэш списков); повторный клик отправляет file_id, который
+# Telegram вернул в первый раз, а если он не принят — тот же файл с диска.
+# Новая загрузка и /wipe удаляют отчёт (invalidate_report / _wipe_tx).
+REPORT_FILES = (
+    ("mutual.csv", "mutual"),
+    ("only_in_following.csv", "only_in_following"),
+    ("only_in_followers.csv", "only_in_followers"),
+    ("new_followers.csv", "new_followers"),
+    ("unfollowers.csv", "unfollowers"),
+    ("new_following.csv", "new_following"),
+    ("unfollowed_by_you.csv", "unfollowed_by_you"),
+    ("new_mutuals.csv", "new_mutuals"),
+    ("lost_mutuals.csv", "lost_mutuals"),
+)
+REPORT_CAPTION = "Полный отчёт (CSV внутри)."
+
+def write_report_zip(path, db_path, lists):
+    # lists: [(имя CSV, массив id)]; имена читаем своим соединением — это может быть процесс пула
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".part"
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        c = conn.cursor()
+        c.execute("BEGIN")
+        with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for fname, ids in lists:
+                names = sorted(_lookup(c, ids).values()) if ids else []
+                with io.TextIOWrapper(zf.open(fname, "w"), encoding="utf-8", newline="") as f:
+                    w = csv.writer(f)
+                    w.writerow(["username"])
+                    w.writerows([n] for n in names)
+                del names
+        c.execute("COMMIT")
+        os.replace(tmp, path)
+    finally:
+        conn.close()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path
 
 def send_current_zip(update: Update, context: CallbackContext, uid: int):
-    data = store_lists.get(uid)
+    data = get_lists(uid)
     if not data:
-        update.effective_message.reply_text("Сначала отправьте ZIP или списки, чтобы я сформировал отчёт.")
-        return
-    export = {
-        "mutual.csv": data.get("mutual", []),
-        "only_in_following.csv": data.get("only_in_following", []),
-        "only_in_followers.csv": data.get("only_in_followers", []),
-        "new_followers.csv": data.get("new_followers", []),
-        "unfollowers.csv": data.get("unfollowers", []),
-        "new_following.csv": data.get("new_following", []),
-        "unfollowed_by_you.csv": data.get("unfollowed_by_you", []),
-        "new_mutuals.csv": data.get("new_mutuals", []),
-        "lost_mutuals.csv": data.get("lost_mutuals", []),
-    }
-    z = build_zip_bytes_from_lists(export)
-    update.effective_message.reply_document(document=InputFile(z, filename="report.zip"), caption="Полный отчёт (CSV внутри).")
+        reply(update, "Сначала отправьте ZIP или списки, чтобы я сформировал отчёт.")
+        return
+    store_lists.put(uid, data)
+    snap_id, digest = get_last_snapshot_id(uid), data.digest()
+
+    path = None
+    row = get_report(uid)
+    if row and row[0] == snap_id and row[1] == digest:
+        if row[3]:
+            try:
+                reply_document(update, document=row[3], caption=REPORT_CAPTION).result()
+                inc("igbot_report_total", source="file_id")
+                return
+            except BadRequest:
+                pass  # file_id больше не принимается — отправим файл заново
+        if os.path.exists(row[2]):
+            path = row[2]
+            inc("igbot_report_total", source="disk")
+    if path is None:
+        path = os.path.join(REPORT_DIR, f"{uid}_{snap_id}_{digest}.zip")
+        with timed("igbot_stage_seconds", stage="build_report"):
+            run_cpu(write_report_zip, path, DB_PATH, data.report_lists())
+        inc("igbot_report_total", source="build")
+
+    with open(path, "rb") as f:
+        sent = reply_document(update, document=InputFile(f, filename="report.zip"), caption=REPORT_CAPTION).result()
+    doc = getattr(sent, "document", None)
+    save_report(uid, snap_id, digest, path, doc.file_id if doc else None)
 
 # ---------- Core processing ----------
+def diff_lists(a, b, prev_a=None, prev_b=None):
+    # a/b — following/followers текущей загрузки, prev_* — прошлого снимка (отсортированные id)
+    mutual, only_a, only_b = merge_diff(a, b)
+    out = {"mutual": mutual, "only_in_following": only_a, "only_in_followers": only_b}
+    if prev_a is not None:
+        _, out["unfollowers"], out["new_followers"] = merge_diff(prev_b, b)
+        _, out["unfollowed_by_you"], out["new_following"] = merge_diff(prev_a, a)
+        prev_mutual, _, _ = merge_diff(prev_a, prev_b)
+        _, out["lost_mutuals"], out["new_mutuals"] = merge_diff(prev_mutual, mutual)
+    return out
+
+LIST_KEYS = (
+    "mutual", "only_in_following", "only_in_followers",
+    "new_followers", "unfollowers", "new_following", "unfollowed_by_you",
+    "new_mutuals", "lost_mutuals",
+)
+
+def rebuild_lists(uid):
+    # списки для кнопок из двух последних снимков — они же были «текущим» и «прошлым» при загрузке
+    with read_tx("rebuild_lists") as c:
+        rows = c.execute("SELECT id FROM snapshots WHERE user_id=? ORDER BY id DESC LIMIT 2", (uid,)).fetchall()
+        if not rows:
+            return None
+        cur = cached_snapshot(c, uid, rows[0][0])
+        prev = cached_snapshot(c, uid, rows[1][0]) if len(rows) > 1 else None
+    return DiffResult(run_cpu(diff_lists, cur["following"], cur["followers"],
+                              prev["following"] if prev else None, prev["followers"] if prev else None))
+
+def intern_sets(A, B):
+    # имена -> отсортированные массивы id (following, followers)
+    inc("igbot_usernames_total", len(A), list="following")
+    inc("igbot_usernames_total", len(B), list="followers")
+    with timed("igbot_stage_seconds", stage="intern"):
+        ids = intern_usernames(set(A).union(B))
+        return array("I", sorted(ids[u] for u in A)), array("I", sorted(ids[u] for u in B))
+
 def process_sets_and_reply(update: Update, context: CallbackContext, uid: int, A: set, B: set):
-    mutual = sorted(A & B)
-    only_in_following = sorted(A - B)
-    only_in_followers = sorted(B - A)
+    process_ids_and_reply(update, context, uid, *intern_sets(A, B))
+
+def reply_unchanged(update: Update, context: CallbackContext, uid: int, a, b, ts):
+    # списки совпали с последним снимком: ничего не пишем, в меню остаются изменения между двумя
+    # последними снимками — те же, что после вытеснения или рестарта соберёт rebuild_lists
+    inc("igbot_dedup_total", kind="snapshot")
+    res = get_lists(uid)
+    show_menu(update, context, uid, text=(
+        f"Готово! С последнего снимка ({ts[:19]} UTC) ничего не изменилось — новый снимок не сохранял.\n"
+        f"Изменения в меню — с предыдущего снимка до последнего.\n\n"
+        f"📸 Текущая сводка:\n"
+        f"• following: {len(a)}  • followers: {len(b)}  • взаимные: {res.count('mutual')}\n\n"
+        f"{MENU_TEXT}"
+    ))
 
+def process_ids_and_reply(update: Update, context: CallbackContext, uid: int, a, b):
+    digest, last_ts = get_last_digest(uid)
+    if digest is not None and digest == ids_digest(a, b):
+        reply_unchanged(update, context, uid, a, b, last_ts)
+        return
     last = load_last_snapshot(uid)
+    if last and digest is None and last["following"] == a and last["followers"] == b:
+        reply_unchanged(update, context, uid, a, b, last["ts"])
+        return
+    with timed("igbot_stage_seconds", stage="diff"):
+        res = DiffResult(run_cpu(diff_lists, a, b, last["following"] if last else None, last["followers"] if last else None))
+    n = res.count
+
     if last:
-        prevA, prevB = last["following"], last["followers"]
-        new_followers = sorted(B - prevB)
-        unfollowers = sorted(prevB - B)
-        new_following = sorted(A - prevA)
-        unfollowed_by_you = sorted(prevA - A)
-        prev_mutual = prevA & prevB
-        new_mutuals = sorted((A & B) - prev_mutual)
-        lost_mutuals = sorted(prev_mutual - (A & B))
         ts = last["ts"][:19] + " UTC"
-
         summary = (
             "Готово!\n"
             f"📸 Текущая сводка:\n"
-            f"• following: {len(A)}  • followers: {len(B)}  • взаимные: {len(mutual)}\n\n"
+            f"• following: {len(a)}  • followers: {len(b)}  • взаимные: {n('mutual')}\n\n"
             f"📈 Изменения с последнего раза ({ts}):\n"
-            f"• 🟢 новые подписчики: {len(new_followers)}\n"
-            f"• 🔴 отписались: {len(unfollowers)}\n"
-            f"• ➕ вы зафолловили: {len(new_following)}\n"
-            f"• ➖ вы отписались: {len(unfollowed_by_you)}\n"
-            f"• ✨ стали взаимными: {len(new_mutuals)}\n"
-            f"• 💔 потеряли взаимность: {len(lost_mutuals)}"
+            f"• 🟢 новые подписчики: {n('new_followers')}\n"
+            f"• 🔴 отписались: {n('unfollowers')}\n"
+            f"• ➕ вы зафолловили: {n('new_following')}\n"
+            f"• ➖ вы отписались: {n('unfollowed_by_you')}\n"
+            f"• ✨ стали взаимными: {n('new_mutuals')}\n"
+            f"• 💔 потеряли взаимность: {n('lost_mutuals')}"
         )
-        update.message.reply_text(summary)
-
-        store_lists[uid] = {
-            "mutual": mutual,
-            "only_in_following": only_in_following,
-            "only_in_followers": only_in_followers,
-            "new_followers": new_followers,
-            "unfollowers": unfollowers,
-            "new_following": new_following,
-            "unfollowed_by_you": unfollowed_by_you,
-            "new_mutuals": new_mutuals,
-            "lost_mutuals": lost_mutuals
-        }
     else:
         summary = (
             "Снимок сохранён! Это первый раз, поэтому сравнить пока не с чем.\n\n"
             f"📸 Текущая сводка:\n"
-            f"• following: {len(A)}  • followers: {len(B)}  • взаимные: {len(mutual)}\n"
+            f"• following: {len(a)}  • followers: {len(b)}  • взаимные: {n('mutual')}\n"
             "Ниже можно открыть списки по кнопкам."
         )
-        update.message.reply_text(summary)
-
-        store_lists[uid] = {
-            "mutual": mutual,
-            "only_in_following": only_in_following,
-            "only_in_followers": only_in_followers,
-            "new_followers": [],
-            "unfollowers": [],
-            "new_following": [],
-            "unfollowed_by_you": [],
-            "new_mutuals": [],
-            "lost_mutuals": []
-        }
-
-    show_menu(update, context, uid)
-    save_snapshot(uid, A, B)
+    store_lists.put(uid, res)
+
+    # сначала снимок, потом сводка с меню: кнопки могут пересобрать списки из базы (get_lists)
+    with timed("igbot_stage_seconds", stage="db_write"):
+        save_snapshot(uid, a, b, prev=last, stats=snapshot_stats(res.count, len(a), len(b), last is not None))
+        invalidate_report(uid)
+    with timed("igbot_stage_seconds", stage="reply"):
+        show_menu(update, context, uid, text=f"{summary}\n\n{MENU_TEXT}")
+
+# ---------- Webhook ----------
+# Приёмник — главный процесс: отвечает Telegram сразу, а тело обновления кладёт в очередь
+# воркера user_id % WEBHOOK_WORKERS. Один пользователь всегда попадает в один процесс (его
+# обновления идут по порядку в один диспетчер, который раздаёт билеты heavy_job), разные —
+# разъезжаются по ядрам.
+# Состояние, которое должно пережить рестарт воркера, лежит в SQLite: сессии (sessions),
+# снимки (списки для кнопок пересобирает get_lists) и отчёты (reports).
+def shard_of(payload, n):
+    for key, obj in payload.items():
+        if key != "update_id" and isinstance(obj, dict):
+            src = obj.get("from") or obj.get("chat") or {}
+            if "id" in src:
+                return src["id"] % n
+    return payload.get("update_id", 0) % n
+
+def webhook_worker(idx, conn):
+    # процесс-воркер: свой Dispatcher, пул потоков и кэши; CPU-пул по умолчанию выключен —
+    # параллельность уже дают сами воркеры
+    global CPU_WORKERS, METRICS_PORT
+    CPU_WORKERS = int(os.getenv("CPU_WORKERS", "0"))
+    if METRICS_PORT:
+        METRICS_PORT += idx + 1
+    start_cache_sweeper()
+    start_cpu_pool()
+    start_outbox(max(1, WEBHOOK_WORKERS))
+    start_metrics_server()
+    bot = Bot(TOKEN, base_url=API_URL, base_file_url=API_FILE_URL,
+              request=Request(con_pool_size=BOT_WORKERS + OUT_SENDERS + 4))
+    dp = Dispatcher(bot, queue.Queue(), workers=BOT_WORKERS, use_context=True)
+    add_handlers(dp)
+    threading.Thread(target=dp.start, name="dispatcher", daemon=True).start()
+    while True:
+        try:
+            raw = conn.recv_bytes()
+        except EOFError:
+            break
+        try:
+            dp.update_queue.put(Update.de_json(json.loads(raw), bot))
+        except Exception as e:
+            print(f"worker {idx}: bad update: {e!r}")
+    dp.stop()
+
+def run_webhook():
+    n = max(1, WEBHOOK_WORKERS)
+    path = urlparse(WEBHOOK_URL).path or "/"
+    # без секрета любой, кто достучится до порта, мог бы прислать обновление от чужого from.id;
+    # webhook ставим сами, поэтому секрет можно придумать на каждый запуск
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    ctx = multiprocessing.get_context("spawn")
+    # очередь воркера живёт в этом процессе, в воркер обновления идут по своему pipe: убитый
+    # воркер уносит только то, что уже было в pipe, остальное дождётся перезапущенного
+    queues = [queue.Queue() for _ in range(n)]
+    procs, conns = [None] * n, [None] * n
+
+    def spawn(i):
+        recv, send = ctx.Pipe(duplex=False)
+        procs[i] = ctx.Process(target=webhook_worker, args=(i, recv), name=f"bot-worker-{i}", daemon=True)
+        procs[i].start()
+        recv.close()
+        old, conns[i] = conns[i], send
+        if old is not None:
+            old.close()  # pipe упавшего воркера; feed() на нём получит OSError и возьмёт новый
+
+    def feed(i):
+        while True:
+            raw = queues[i].get()
+            while True:
+                try:
+                    conns[i].send_bytes(raw)
+                    break
+                except OSError:
+                    time.sleep(0.2)  # воркер упал — ждём, пока supervise() поднимет новый
+
+    def supervise():
+        while True:
+            time.sleep(1)
+            for i, p in enumerate(procs):
+                if not p.is_alive():
+                    print(f"worker {i} exited with {p.exitcode}, restarting")
+                    inc("igbot_worker_restarts_total")
+                    spawn(i)
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path or not secrets.compare_digest(self.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+                self.send_error(403)
+                return
+            raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            try:
+                i = shard_of(json.loads(raw), n)
+            except (ValueError, AttributeError):
+                self.send_error(400)
+                return
+            queues[i].put(raw)
+            inc("igbot_webhook_updates_total", worker=i)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        def log_message(self, *args):
+            pass
+
+    for i in range(n):
+        spawn(i)
+        threading.Thread(target=feed, args=(i,), name=f"feed-{i}", daemon=True).start()
+    threading.Thread(target=supervise, name="supervisor", daemon=True).start()
+    start_metrics_server()
+    srv = ThreadingHTTPServer((WEBHOOK_LISTEN, WEBHOOK_PORT), WebhookHandler)
+    Bot(TOKEN, base_url=API_URL).set_webhook(url=WEBHOOK_URL, secret_token=secret)
+    print(f"Bot v3.4 webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{path}, {n} workers")
+    try:
+        srv.serve_forever()
+    finally:
+        for c in conns:
+            c.close()
 
 # ---------- Main ----------
+def receive_update(update: Update, context: CallbackContext):
+    # группа -1, синхронно в потоке диспетчера, до раздачи обработчиков run_async
+    if METRICS_ENABLED:
+        stamp_update(update, context)
+    issue_ticket(update, context)
+
+def add_handlers(dp):
+    dp.add_handler(TypeHandler(Update, receive_update), group=-1)
+    dp.add_handler(CommandHandler("start", start, run_async=True))
+    dp.add_handler(CommandHandler("help", help_cmd, run_async=True))
+    dp.add_handler(CommandHandler("howto", howto_cmd, run_async=True))
+    dp.add_handler(CommandHandler("stats", stats_cmd, run_async=True))
+    dp.add_handler(CommandHandler("history", history_cmd, run_async=True))
+    dp.add_handler(CommandHandler("compare", compare_cmd, run_async=True))
+    dp.add_handler(CommandHandler("delete", delete_cmd, run_async=True))
+    dp.add_handler(CommandHandler("metrics", metrics_cmd, run_async=True))
+    dp.add_handler(CallbackQueryHandler(handle_callback, run_async=True))
+    dp.add_handler(MessageHandler(Filters.document, handle_document, run_async=True))
+    dp.add_handler(MessageHandler(Filters.text & (~Filters.command), handle_text, run_async=True))
+
 def main():
+    if not TOKEN:
+        print("Error: TELEGRAM_TOKEN not set in .env")
+        exit(1)
     init_db()
-    updater = Updater(TOKEN, use_context=True)
-    dp = updater.dispatcher
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("help", help_cmd))
-    dp.add_handler(CommandHandler("howto", howto_cmd))
-    dp.add_handler(CommandHandler("stats", stats_cmd))
-    dp.add_handler(CommandHandler("delete", delete_cmd))
-    dp.add_handler(CallbackQueryHandler(handle_callback))
-    dp.add_handler(MessageHandler(Filters.document, handle_document))
-    dp.add_handler(MessageHandler(Filters.text & (~Filters.command), handle_text))
+    start_retention_sweeper()
+    start_names_sweeper()
+    start_stats_backfill()
+    if WEBHOOK_URL:
+        run_webhook()
+        return
+    start_cache_sweeper()
+    start_cpu_pool()
+    start_outbox()
+    start_metrics_server()
+    # соединений к API: потоки диспетчера + отправители outbox + запас под getUpdates
+    updater = Updater(TOKEN, use_context=True, workers=BOT_WORKERS, base_url=API_URL, base_file_url=API_FILE_URL,
+                      request_kwargs={"con_pool_size": BOT_WORKERS + OUT_SENDERS + 4})
+    add_handlers(updater.dispatcher)
     print("Bot v3.4 starting...")
     updater.start_polling()
     updater.idle()
@@ -0,0 +1,212 @@
+# Офлайн-импорт архивов Instagram в базу бота, без Telegram.
+#
+#   python import_archives.py exports/                # exports/<user_id>/*.zip
+#   python import_archives.py manifest.csv            # строки: user_id,archive[,timestamp]
+#   python import_archives.py exports/ --db other.db --workers 8 --batch 200
+#
+# Архивы разбираются в пуле процессов (parse_zip_for_users), снимки пишутся пачками по --batch
+# в одной транзакции с историческим временем: из манифеста (ISO 8601 или unix time), из даты
+# в имени файла (instagram-name-2024-05-01-...zip) или по mtime файла. Снимки пользователя идут
+# по возрастанию времени; каждый проведённый архив отмечается в imported_archives в той же
+# транзакции, так что прерванный импорт можно просто запустить ещё раз. Архив, совпавший
+# с предыдущим снимком, не записывается.
+#
+# Ограничение: снимок встаёт только после последнего снимка пользователя (дельты и «последний
+# снимок» бота идут по порядку id). Архивы старше истории, которая уже есть в базе (например,
+# бот успел сохранить живой снимок), не импортируются и считаются отдельно — «старше истории».
+# Чтобы загрузить такие архивы, импортируйте их до начала работы бота с пользователем или
+# после /wipe.
+import argparse, csv, datetime, os, re, sys, time, multiprocessing
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import bot
+
+DATE_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})(?:[T_ ](\d{2})[:-]?(\d{2})[:-]?(\d{2}))?")
+
+def parse_ts(value):
+    # -> isoformat в UTC без зоны, как пишет save_snapshot
+    value = value.strip()
+    if re.fullmatch(r"\d+(\.\d+)?", value):
+        return datetime.datetime.utcfromtimestamp(float(value)).isoformat()
+    dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo:
+        dt = dt.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return dt.isoformat()
+
+def ts_from_file(path):
+    m = DATE_RE.search(os.path.basename(path))
+    if m:
+        try:
+            return datetime.datetime(*(int(x) for x in m.groups() if x is not None)).isoformat()
+        except ValueError:
+            pass
+    return datetime.datetime.utcfromtimestamp(os.path.getmtime(path)).isoformat()
+
+def scan_dir(root):
+    jobs = []
+    for name in sorted(os.listdir(root)):
+        d = os.path.join(root, name)
+        if not (os.path.isdir(d) and name.isdigit()):
+            continue
+        for fn in sorted(os.listdir(d)):
+            if fn.lower().endswith(".zip"):
+                path = os.path.join(d, fn)
+                jobs.append((int(name), path, ts_from_file(path)))
+    return jobs
+
+def read_manifest(path):
+    # пути к архивам — относительно каталога манифеста; заголовок и строки с # пропускаются
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip().isdigit():
+                continue
+            archive = os.path.join(base, row[1].strip())
+            ts = parse_ts(row[2]) if len(row) > 2 and row[2].strip() else ts_from_file(archive)
+            jobs.append((int(row[0]), archive, ts))
+    return jobs
+
+def parse_archive(path):
+    # в процессе пула: (following, followers) или текст ошибки — один битый архив не валит импорт
+    try:
+        return bot.parse_zip_for_users(path)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+def _import_tx(c, items, last):
+    # items: [(uid, ts, following, followers)] по порядку; last: uid -> последний снимок
+    # (подгружается из базы при первой встрече пользователя) и "names" — name -> id всех его
+    # уже встречавшихся имён: соседние архивы почти совпадают, в словарь идут только новые
+    written = unchanged = 0
+    for uid, ts, following, followers in items:
+        if uid not in last:
+            row = c.execute("SELECT last_id FROM user_summary WHERE user_id=?", (uid,)).fetchone()
+            last[uid] = bot._reconstruct(c, uid, row[0]) if row else None
+        prev = last[uid]
+        names = prev.get("names", {}) if prev else {}
+        names.update(bot._intern(c, [u for u in set(following).union(followers) if u not in names]))
+        a = array("I", sorted(names[u] for u in following))
+        b = array("I", sorted(names[u] for u in followers))
+        if prev and prev["following"] == a and prev["followers"] == b:
+            prev["names"] = names
+            unchanged += 1
+            c.execute("INSERT OR IGNORE INTO imported_archives (user_id, ts) VALUES (?, ?)", (uid, ts))
+            continue
+        sid = bot._save_snapshot_tx(c, uid, a, b, prev, None, ts)
+        last[uid] = {"id": sid, "ts": ts, "following": a, "followers": b, "names": names}
+        written += 1
+        c.execute("INSERT OR IGNORE INTO imported_archives (user_id, ts) VALUES (?, ?)", (uid, ts))
+    # дальше в очереди только этот пользователь и следующие — остальные снимки не держим
+    keep = items[-1][0] if items else None
+    for uid in [u for u in last if u != keep]:
+        del last[uid]
+    return written, unchanged
+
+def run(jobs, workers, batch):
+    jobs.sort(key=lambda j: (j[0], j[2], j[1]))
+    with bot.read_tx("import_plan") as c:
+        last_ts = dict(c.execute("SELECT user_id, last_ts FROM user_summary"))
+        done = set(c.execute("SELECT user_id, ts FROM imported_archives"))
+    todo, seen = [], set()
+    skipped = dict(imported=0, older=0, dupes=0)
+    for uid, path, ts in jobs:
+        if (uid, ts) in done:
+            skipped["imported"] += 1
+        elif (uid, ts) in seen:
+            skipped["dupes"] += 1  # второй архив пользователя с тем же временем
+        elif ts <= last_ts.get(uid, ""):
+            skipped["older"] += 1
+        else:
+            seen.add((uid, ts))
+            todo.append((uid, path, ts))
+    if skipped["older"]:
+        print(f"архивов старше истории в базе: {skipped['older']} — снимок встаёт только после последнего "
+              f"снимка пользователя, их не импортирую", flush=True)
+
+    t0 = time.monotonic()
+    n = dict(done=0, written=0, unchanged=0, failed=0, usernames=0, bytes=0)
+    last, pending = {}, []
+    shown = 0.0
+    writes = ThreadPoolExecutor(max_workers=1)  # пачка пишется, пока пул разбирает следующие
+    inflight = None
+
+    def flush():
+        nonlocal inflight
+        if inflight is not None:
+            w, u = inflight.result()
+            n["written"] += w
+            n["unchanged"] += u
+            inflight = None
+        if pending:
+            inflight = writes.submit(bot.db_write, _import_tx, list(pending), last)
+            pending.clear()
+
+    def progress(final=False):
+        nonlocal shown
+        now = time.monotonic()
+        if not final and now - shown < 1:
+            return
+        shown = now
+        dt = max(now - t0, 1e-9)
+        rate = n["done"] / dt
+        eta = (len(todo) - n["done"]) / rate if rate else 0
+        print(f"[{n['done']}/{len(todo)}] {rate:.1f} арх/с, записано {n['written']}, ETA {eta:.0f} с", flush=True)
+
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        # окно вперёд по 2 архива на процесс: разбор параллельный, запись — строго по порядку
+        queue_, it = deque(), iter(todo)
+        def fill():
+            while len(queue_) < workers * 2:
+                job = next(it, None)
+                if job is None:
+                    return
+                queue_.append((job, pool.submit(parse_archive, job[1])))
+        fill()
+        while queue_:
+            (uid, path, ts), fut = queue_.popleft()
+            fill()
+            res = fut.result()
+            n["done"] += 1
+            if isinstance(res, str) or not (res[0] or res[1]):
+                n["failed"] += 1
+                print(f"  ! {path}: {res if isinstance(res, str) else 'списки не найдены'}", flush=True)
+            else:
+                pending.append((uid, ts, res[0], res[1]))
+                n["usernames"] += len(res[0]) + len(res[1])
+                n["bytes"] += os.path.getsize(path)
+                if len(pending) >= batch:
+                    flush()
+            progress()
+        flush()
+        flush()  # дождаться последней пачки
+    writes.shutdown()
+    progress(final=True)
+
+    dt = max(time.monotonic() - t0, 1e-9)
+    print(f"\nимпорт: {n['written']} снимков из {len(todo)} архивов за {dt:.1f} с — "
+          f"{len(todo) / dt:.1f} арх/с, {n['usernames'] / dt:,.0f} имён/с, {n['bytes'] / dt / 2**20:.1f} МБ/с")
+    print(f"пропущено: уже импортированы {skipped['imported']}, старше истории {skipped['older']}, "
+          f"повторы по времени {skipped['dupes']}, без изменений {n['unchanged']}, с ошибками {n['failed']}")
+    return n
+
+def main():
+    ap = argparse.ArgumentParser(description="Импорт архивов Instagram в базу бота")
+    ap.add_argument("source", help="каталог <user_id>/*.zip или CSV-манифест user_id,archive[,timestamp]")
+    ap.add_argument("--db", default=bot.DB_PATH)
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--batch", type=int, default=100, help="снимков в одной транзакции")
+    args = ap.parse_args()
+
+    bot.DB_PATH = args.db
+    bot.init_db()
+    jobs = scan_dir(args.source) if os.path.isdir(args.source) else read_manifest(args.source)
+    if not jobs:
+        print("нечего импортировать")
+        sys.exit(1)
+    run(jobs, max(1, args.workers), max(1, args.batch))
+
+if __name__ == "__main__":
+    main()
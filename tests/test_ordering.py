@@ -0,0 +1,39 @@
+# Порядок тяжёлых задач одного пользователя: номер берётся в потоке диспетчера (issue_ticket),
+# поэтому обработчики, которые run_async запустил в обратном порядке, всё равно идут по очереди.
+#   python -m pytest -q tests
+import datetime, os, sys, threading, time, types, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+from telegram import Chat, Message, Update, User
+from telegram.ext import Filters, MessageHandler
+
+def _update(update_id, uid, text):
+    user = User(uid, f"u{uid}", False)
+    msg = Message(update_id, datetime.datetime.utcnow(), Chat(uid, "private"), from_user=user, text=text)
+    return Update(update_id, message=msg)
+
+class HeavyOrderTest(unittest.TestCase):
+    def test_tickets_keep_arrival_order(self):
+        order = []
+        def handler(update, context):
+            order.append(update.effective_message.text)
+        wrapped = bot.heavy(handler)
+        context = types.SimpleNamespace(dispatcher=types.SimpleNamespace(
+            handlers={0: [MessageHandler(Filters.text, wrapped)]}))
+        first, second = _update(1, 42, "following"), _update(2, 42, "followers")
+        for u in (first, second):
+            bot.issue_ticket(u, context)
+        # второй обработчик стартует раньше и ждёт хода первого
+        t = threading.Thread(target=wrapped, args=(second, context))
+        t.start()
+        time.sleep(0.1)
+        self.assertEqual(order, [])
+        wrapped(first, context)
+        t.join(5)
+        self.assertEqual(order, ["following", "followers"])
+        self.assertEqual(bot._user_jobs, {})
+        self.assertEqual(bot._tickets, {})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+# Потоковый разбор JSON из выгрузок: JsonStream с любым размером куска читает то же, что
+# json.loads, в том числе когда граница куска режет число после '.' или 'e'.
+#   python -m pytest -q tests
+import io, json, os, sys, unittest, zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+DOC = {
+    "relationships_following": [
+        {"title": "", "media_list_data": [], "string_list_data": [
+            {"href": f"https://www.instagram.com/user_{i}", "value": f"user_{i}", "timestamp": 1700000000 + i}]}
+        for i in range(20)
+    ],
+    "score": 2.5, "ratio": -1.25e-3, "big": 6E+10, "n": 12345, "zero": 0.0, "ok": True, "none": None,
+    "nested": {"xs": [1.5, 2e3, -7, 3.25E-2], "s": "a, b: [c]"},
+}
+
+def _stream_items(raw, chunk):
+    return [(k, x) for k, x, _ in bot.JsonStream(io.BytesIO(raw), chunk=chunk).items()]
+
+class JsonStreamTest(unittest.TestCase):
+    def test_tiny_chunks_match_json_loads(self):
+        raw = json.dumps(DOC).encode()
+        want = json.loads(raw)
+        for chunk in (1, 2, 3, 5, 7, 64):
+            got = {}
+            for k, x in _stream_items(raw, chunk):
+                if k in got and isinstance(want[k], list):
+                    got[k].append(x)
+                elif isinstance(want[k], list):
+                    got[k] = [x]
+                else:
+                    got[k] = x
+            self.assertEqual(got, want, f"chunk={chunk}")
+
+    def test_number_split_after_dot_in_zip(self):
+        # '.' — последний байт первого куска ZIP_CHUNK: "x": 2. | 5
+        head = '{"relationships_following": [{"string_list_data": [{"value": "alice"}]}], "x": 2'
+        pad = " " * (bot.ZIP_CHUNK - 1 - len(head))
+        raw = (head[:-1] + pad + "2.5, \"y\": 1e5}").encode()
+        self.assertEqual(raw.index(b"."), bot.ZIP_CHUNK - 1)
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as z:
+            z.writestr("connections/followers_and_following/following.json", raw)
+        following, followers = bot.parse_zip_for_users(buf.getvalue())
+        self.assertEqual(set(following), {"alice"})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+# Хранилище снимков: база старого формата (JSON-колонки) проходит все миграции init_db(),
+# снимки восстанавливаются в исходные множества, в том числе после retention, который
+# переписывает осиротевшие дельты в ключевые кадры; имена удалённых снимков уходят из словаря.
+#   python -m pytest -q tests
+import datetime, json, os, random, shutil, sqlite3, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+USERS = (101, 202)
+N_SNAPSHOTS = 10
+_tmp = None
+_history = {}  # uid -> [(ts, following, followers)] по порядку записи
+
+def _churn(names, rnd, k):
+    kept = rnd.sample(sorted(names), len(names) - k)
+    return set(kept) | {f"new_{rnd.getrandbits(40):x}" for _ in range(k)}
+
+def _seed_legacy(path):
+    # схема и запись как до v1: полные списки JSON в каждой строке
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE snapshots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            ts TEXT NOT NULL,
+            following_json TEXT NOT NULL,
+            followers_json TEXT NOT NULL
+        )
+    """)
+    rnd = random.Random(7)
+    now = datetime.datetime.utcnow()
+    base = {f"user_{i}" for i in range(400)}
+    for i in range(N_SNAPSHOTS):
+        for uid in USERS:
+            prev = _history.setdefault(uid, [])
+            following = _churn(prev[-1][1], rnd, 8) if prev else set(rnd.sample(sorted(base), 250))
+            followers = _churn(prev[-1][2], rnd, 10) if prev else set(rnd.sample(sorted(base), 300))
+            # снимки раз в 10 дней, самый старый — 100 дней назад
+            ts = (now - datetime.timedelta(days=100 - 10 * i)).isoformat()
+            conn.execute(
+                "INSERT INTO snapshots (user_id, ts, following_json, followers_json) VALUES (?, ?, ?, ?)",
+                (uid, ts, json.dumps(sorted(following)), json.dumps(sorted(followers)))
+            )
+            prev.append((ts, following, followers))
+    conn.commit()
+    conn.close()
+
+def setUpModule():
+    global _tmp
+    _tmp = tempfile.mkdtemp(prefix="igbot_test_")
+    bot.DB_PATH = os.path.join(_tmp, "legacy.db")
+    _seed_legacy(bot.DB_PATH)
+    bot.init_db()
+
+def tearDownModule():
+    shutil.rmtree(_tmp, ignore_errors=True)
+
+def _names(snap):
+    return (set(bot.lookup_usernames(snap["following"]).values()),
+            set(bot.lookup_usernames(snap["followers"]).values()))
+
+def _snapshot_ids(uid):
+    return [r[0] for r in bot.db().execute("SELECT id FROM snapshots WHERE user_id=? ORDER BY id", (uid,))]
+
+class LegacyMigrationTest(unittest.TestCase):
+    def test_schema_is_current(self):
+        self.assertEqual(bot.db().execute("PRAGMA user_version").fetchone()[0], len(bot.MIGRATIONS))
+
+    def test_deltas_are_used(self):
+        n = bot.db().execute("SELECT COUNT(*) FROM snapshots WHERE base_id IS NOT NULL").fetchone()[0]
+        self.assertGreater(n, 0)
+
+    def test_round_trip(self):
+        uid = USERS[0]
+        ids = _snapshot_ids(uid)
+        self.assertEqual(len(ids), N_SNAPSHOTS)
+        for sid, (ts, following, followers) in zip(ids, _history[uid]):
+            with bot.read_tx() as c:
+                snap = bot._reconstruct(c, uid, sid)
+            self.assertEqual(snap["ts"], ts)
+            self.assertEqual(_names(snap), (following, followers))
+
+    def test_retention_keeps_chains_intact(self):
+        uid = USERS[1]
+        deleted = bot.db_write(bot._cleanup_tx, uid, 45)
+        self.assertEqual(deleted, 6)  # 100..50 дней назад
+        ids = _snapshot_ids(uid)
+        self.assertEqual(len(ids), N_SNAPSHOTS - deleted)
+        # первый уцелевший был дельтой от удалённого — теперь он ключевой кадр
+        self.assertIsNone(bot.db().execute("SELECT base_id FROM snapshots WHERE id=?", (ids[0],)).fetchone()[0])
+        for sid, (ts, following, followers) in zip(ids, _history[uid][deleted:]):
+            self.assertEqual(_names(bot.load_snapshot(uid, sid)), (following, followers))
+        self.assertEqual(_names(bot.load_last_snapshot(uid)), _history[uid][-1][1:])
+
+class NameSweepTest(unittest.TestCase):
+    def test_wiped_names_are_removed(self):
+        uid = 303
+        mine = {f"wiped_{i}" for i in range(50)}
+        ids = bot.intern_usernames(mine | {"shared_name"})
+        a = bot.array("I", sorted(ids.values()))
+        bot.save_snapshot(uid, a, a)
+        bot.wipe_user_history(uid)
+        bot.intern_usernames(["sentinel_top"])  # строка с наибольшим id не удаляется — пусть это будет она
+
+        bot.sweep_usernames()  # первый проход только отмечает кандидатов
+        self.assertEqual(len(bot.lookup_usernames(ids.values())), len(ids))
+        bot.intern_usernames(["shared_name"])  # имя снова выдано — с очереди снимается
+        bot.sweep_usernames()
+        self.assertEqual(set(bot.lookup_usernames(ids.values()).values()), {"shared_name"})
+        # имена живых снимков на месте
+        uid = USERS[0]
+        self.assertEqual(_names(bot.load_last_snapshot(uid)), _history[uid][-1][1:])
+
+if __name__ == "__main__":
+    unittest.main()